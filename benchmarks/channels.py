@@ -0,0 +1,104 @@
+"""
+Benchmark Channels.update (one status poll) for 100, 1k and 10k channels
+
+Measures CPU time and peak memory of the update, including json decoding of
+the server responses (but no network), and compares with the previous
+implementation that created a full pydantic model for every channel.
+"decode" is json decoding of the channel list alone, for reference.
+
+The update ("streamed") decodes responses item by item from chunks, so the
+peak memory does not include the decoded responses.
+
+    python benchmarks/channels.py
+"""
+
+import gc
+import time
+import tracemalloc
+from collections.abc import Callable
+from typing import Any
+
+from fakeserver import TEAM_ID, USER_ID, FakeMattermost, Fixtures
+from pydantic import BaseModel
+
+from mmtools.mattermost import Channels
+
+
+class LegacyChannel(BaseModel):
+    """Channel model as it was before the slotted representation"""
+
+    id: str | None
+    type: str | None
+    header: str | None
+    purpose: str | None
+    display_name: str | None
+    name: str = ""
+    mention_count: int | None
+    msg_count: int | None
+    update_at: int | None
+    last_post_at: int | None
+    total_msg_count: int | None
+    dirty: bool | None = None
+
+    @property
+    def msg_unread_count(self) -> int:
+        if self.total_msg_count is None or self.msg_count is None:
+            return 0
+
+        return self.total_msg_count - self.msg_count
+
+
+def legacy_update(mm: FakeMattermost) -> list[LegacyChannel]:
+    """Channels.update before the slotted representation"""
+    channel_members = {
+        channel["channel_id"]: channel
+        for channel in mm.api.get_channel_members_for_user(USER_ID, TEAM_ID)
+    }
+
+    result = []
+    for channel in mm.api.get_if_none_match("", None)[0]:
+        channel.update(channel_members[channel["id"]])
+        channel = LegacyChannel(**channel)
+
+        if not channel.msg_unread_count:
+            continue
+
+        result.append(channel)
+    return result
+
+
+def measure(func: Callable[[], Any], repeat: int) -> tuple[float, int]:
+    """Returns (best cpu seconds per call, peak bytes)"""
+    gc.collect()
+    timings = []
+    for _ in range(repeat):
+        start = time.process_time()
+        func()
+        timings.append(time.process_time() - start)
+    cpu = min(timings)
+
+    tracemalloc.start()
+    func()
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return (cpu, peak)
+
+
+def main() -> None:
+    print(f"{'channels':>8} {'impl':>8} {'cpu/poll':>10} {'peak mem':>10}")
+    for count in (100, 1000, 10000):
+        mm = FakeMattermost(Fixtures.create(channels=count, users=count))
+        repeat = max(10, 10000 // count)
+
+        for name, func in (
+            ("decode", lambda mm=mm: mm.api.get_if_none_match("", None)),
+            ("legacy", lambda mm=mm: legacy_update(mm)),
+            ("streamed", lambda mm=mm: Channels().update(mm, USER_ID, [TEAM_ID])),
+        ):
+            (cpu, peak) = measure(func, repeat)
+            print(f"{count:>8} {name:>8} {cpu * 1000:>8.2f}ms {peak / 1024:>8.0f}kB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Benchmark EventHandler.event_handler by replaying a websocket event stream
+
+Replays a recorded stream (one raw websocket frame per line, or an mmwatch
+event journal) or a synthetic stream with the typical mix of events (mostly
+typing/status_change), and compares with the previous implementation that
+decoded every event fully, and with journaling enabled. Notifications and
+signals are disabled.
+
+    python benchmarks/events.py [recorded.jsonl | ~/.cache/mmtools/journal-*.jsonl]
+"""
+
+import asyncio
+import json
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from fakeserver import FakeMattermost, Fixtures
+
+from mmtools import journal
+from mmtools.watch import EventHandler
+
+
+class LegacyHandler(EventHandler):
+    """event_handler as it was before lazy decoding"""
+
+    async def event_handler(self, event: str) -> None:
+        debug_event = (
+            "status_change",
+            "typing",
+            "channel_member_updated",
+            "user_added",
+            None,
+        )
+
+        d = json.loads(event)
+        if "data" in d:
+            for field, value in d["data"].items():
+                if isinstance(field, str):
+                    try:
+                        d["data"][field] = json.loads(value)
+                    except ValueError:
+                        pass
+                    except TypeError:
+                        pass
+
+        event = d.get("event", None)
+
+        if event in self.event_map:
+            await self.event_map[event](d)
+        elif event in debug_event:
+            logging.debug(json.dumps(d, indent=4, sort_keys=True))
+        else:
+            logging.info(json.dumps(d, indent=4, sort_keys=True))
+
+
+async def replay(handler: EventHandler, events: list[str]) -> float:
+    """Replay events through handler, returns seconds"""
+    start = time.perf_counter()
+    await journal.replay(iter(events), handler.event_handler)
+    if handler.journal:
+        handler.journal.sync()
+    return time.perf_counter() - start
+
+
+def load(path: Path) -> list[str]:
+    """Events of recorded stream or journal"""
+    lines = path.read_text().splitlines()
+
+    if lines and not lines[0].startswith("{"):
+        return list(journal.read(path))
+
+    return lines
+
+
+def main() -> None:
+    # Log to nowhere at INFO, as mmwatch does per default
+    logging.basicConfig(level=logging.INFO, handlers=[logging.NullHandler()])
+
+    fixtures = Fixtures.create(channels=1000, users=100)
+
+    if len(sys.argv) > 1:
+        events = load(Path(sys.argv[1]))
+    else:
+        fixtures.create_events(50000)
+        events = fixtures.events
+
+    tmp = tempfile.TemporaryDirectory()
+    event_journal = journal.Journal(
+        Path(tmp.name) / "journal.jsonl", max_bytes=8 * 1024 * 1024, sync_interval=1
+    )
+
+    print(f"{len(events)} events")
+    for name, cls, recorder in (
+        ("legacy", LegacyHandler, None),
+        ("lazy", EventHandler, None),
+        ("journal", EventHandler, event_journal),
+    ):
+        handler = cls(
+            FakeMattermost(fixtures),  # type: ignore
+            None,
+            "",
+            True,
+            "",
+            event_journal=recorder,
+        )
+        seconds = min(asyncio.run(replay(handler, events)) for _ in range(3))
+        print(
+            f"{name:>8} {seconds:.3f}s {len(events) / seconds:>10.0f} events/s "
+            f"{seconds / len(events) * 1e6:>6.1f}µs/event"
+        )
+
+    event_journal.close()
+    tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,609 @@
+"""
+Local stand-in for a Mattermost server, used by the benchmarks
+
+Serves the REST endpoints used by mmtools (plain http) and a websocket that
+replays a list of events, from synthetic fixtures of any size. Websocket
+connections can be dropped, and posts added while clients are disconnected.
+The server never resumes a connection, so clients must fetch missed posts.
+Responses are gzip compressed if the client accepts it, as Mattermost does. The websocket
+is a minimal RFC 6455 implementation on the same port as the REST api, as
+the mattermost driver expects.
+
+FakeMattermost is a stand-in for mmtools.mattermost.Mattermost without any
+server (or network), serving the same fixtures, for benchmarks of decoding
+and event handling alone.
+"""
+
+import base64
+import gzip
+import hashlib
+import json
+import random
+import re
+import socket
+import struct
+import threading
+import uuid
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from urllib.parse import parse_qs, urlparse
+
+from mmtools import jsonstream
+from mmtools.channel import Channel
+from mmtools.mattermost import CHUNK_SIZE, Channels, User
+
+TOKEN = "benchmarktoken"
+USERNAME = "me"
+USER_ID = "u" * 26
+TEAM_ID = "t" * 26
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+@dataclass
+class Fixtures:
+    """Synthetic users, teams, channels and channel members"""
+
+    users: dict[str, dict[str, Any]]
+    teams: list[dict[str, Any]]
+    channels: list[dict[str, Any]]
+    members: list[dict[str, Any]]
+    events: list[str] = field(default_factory=list)
+    posts: dict[str, list[dict[str, Any]]] = field(default_factory=dict)
+
+    @classmethod
+    def create(
+        cls,
+        channels: int,
+        users: int,
+        unread: float = 0.05,
+        seed: int = 1,
+        teams: int = 1,
+    ) -> "Fixtures":
+        """
+        Create fixtures with `channels` channels (1/4 of them 1-1 chats, the
+        other channels spread over `teams` teams), `users` other users and
+        `unread` share of channels with unread messages
+        """
+        rng = random.Random(seed)
+        all_teams = [
+            {
+                "id": TEAM_ID if n == 0 else f"t{n:025d}",
+                "name": "team" if n == 0 else f"team-{n}",
+                "display_name": f"Team {n}",
+            }
+            for n in range(teams)
+        ]
+        all_users = {
+            USER_ID: {
+                "id": USER_ID,
+                "username": USERNAME,
+                "first_name": "",
+                "last_name": "",
+            }
+        }
+        for n in range(users):
+            user_id = f"{n:026d}"
+            all_users[user_id] = {
+                "id": user_id,
+                "username": f"user{n}",
+                "first_name": "First",
+                "last_name": f"Last {n}",
+            }
+        other_users = [user_id for user_id in all_users if user_id != USER_ID]
+
+        all_channels = []
+        all_members = []
+        for n in range(channels):
+            channel_id = f"c{n:025d}"
+            direct = n % 4 == 0 and other_users
+            total = rng.randrange(1, 1000)
+            all_channels.append(
+                {
+                    "id": channel_id,
+                    "create_at": 1600000000000,
+                    "update_at": 1600000000000 + n,
+                    "delete_at": 0,
+                    "team_id": "" if direct else all_teams[n % teams]["id"],
+                    "type": "D" if direct else rng.choice("OOOP"),
+                    "display_name": "" if direct else f"Channel {n}",
+                    "name": f"{USER_ID}__{other_users[n % len(other_users)]}"
+                    if direct
+                    else f"channel-{n}",
+                    "header": "Channel header " * 10,
+                    "purpose": "Channel purpose " * 10,
+                    "last_post_at": 1600000000000 + n,
+                    "total_msg_count": total,
+                    "extra_update_at": 0,
+                    "creator_id": USER_ID,
+                }
+            )
+            all_members.append(
+                {
+                    "channel_id": channel_id,
+                    "user_id": USER_ID,
+                    "roles": "channel_user",
+                    "last_viewed_at": 1600000000000,
+                    "msg_count": total - rng.randrange(1, 5)
+                    if rng.random() < unread
+                    else total,
+                    "mention_count": 0,
+                    "notify_props": {"desktop": "default", "mark_unread": "all"},
+                    "last_update_at": 1600000000000,
+                }
+            )
+
+        return cls(all_users, all_teams, all_channels, all_members)
+
+    def unread_channels(self) -> list[Channel]:
+        """
+        Channels with unread messages, as mmtools keeps them. 1-1 chats are
+        named after the other user
+        """
+        members = {member["channel_id"]: member for member in self.members}
+        channels = []
+
+        for channel in self.channels:
+            member = members[channel["id"]]
+
+            if member["msg_count"] == channel["total_msg_count"]:
+                continue
+
+            display_name = channel["display_name"]
+            if channel["type"] == "D":
+                display_name = self.users[channel["name"].split("__")[1]]["username"]
+
+            channels.append(
+                Channel(
+                    id=channel["id"],
+                    type=channel["type"],
+                    team_id=channel["team_id"],
+                    display_name=display_name,
+                    name=channel["name"],
+                    msg_count=member["msg_count"],
+                    total_msg_count=channel["total_msg_count"],
+                )
+            )
+
+        return channels
+
+    def create_events(self, count: int, seed: int = 1) -> None:
+        """Create websocket event stream, with the typical mix of events"""
+        rng = random.Random(seed)
+        users = list(self.users)
+        self.events = []
+        for n in range(count):
+            channel = rng.choice(self.channels)
+            if channel["type"] == "D":
+                # Posts in 1-1 chats are from the other user
+                user_id = channel["name"].split("__")[1]
+            else:
+                user_id = rng.choice(users)
+            kind = rng.random()
+            event: dict[str, Any]
+            if kind < 0.6:
+                event = {
+                    "event": "typing",
+                    "data": {"parent_id": "", "user_id": user_id},
+                    "broadcast": {"channel_id": channel["id"]},
+                }
+            elif kind < 0.85:
+                event = {
+                    "event": "status_change",
+                    "data": {"status": "online", "user_id": user_id},
+                    "broadcast": {"user_id": user_id},
+                }
+            elif kind < 0.95:
+                event = {
+                    "event": "posted",
+                    "data": {
+                        "channel_display_name": channel["display_name"],
+                        "channel_name": channel["name"],
+                        "channel_type": channel["type"],
+                        "mentions": json.dumps([USER_ID] if n % 7 == 0 else []),
+                        "post": json.dumps(
+                            {
+                                "id": f"p{n:025d}",
+                                "create_at": 1700000000000 + n,
+                                "user_id": user_id,
+                                "channel_id": channel["id"],
+                                "message": "Lorem ipsum dolor sit amet " * 4,
+                                "type": "",
+                                "props": {},
+                            }
+                        ),
+                        "sender_name": f"@{self.users[user_id]['username']}",
+                        "set_online": True,
+                        "team_id": channel["team_id"],
+                    },
+                    "broadcast": {"channel_id": channel["id"]},
+                }
+            else:
+                event = {
+                    "event": "channel_viewed",
+                    "data": {"channel_id": channel["id"]},
+                    "broadcast": {"user_id": USER_ID},
+                }
+            event["seq"] = n + 1
+            self.events.append(json.dumps(event))
+
+    def add_posts(self, count: int, seed: int = 1) -> None:
+        """Add posts (from other users) to random channels, after all existing posts"""
+        rng = random.Random(seed)
+        users = [user_id for user_id in self.users if user_id != USER_ID]
+        create_at = max(channel["last_post_at"] for channel in self.channels)
+        for n in range(count):
+            channel = rng.choice(self.channels)
+            create_at += 1
+            post_id = f"r{create_at:025d}"
+            self.posts.setdefault(channel["id"], []).append(
+                {
+                    "id": post_id,
+                    "create_at": create_at,
+                    "update_at": create_at,
+                    "delete_at": 0,
+                    "user_id": channel["name"].split("__")[1]
+                    if channel["type"] == "D"
+                    else rng.choice(users),
+                    "channel_id": channel["id"],
+                    "message": f"Missed post {n}",
+                    "type": "",
+                    "props": {},
+                }
+            )
+            channel["last_post_at"] = create_at
+            channel["total_msg_count"] += 1
+
+
+class FakeServer:
+    """
+    Fake Mattermost server on localhost, started in background threads.
+    `requests` counts requests per endpoint, `bytes_sent` the body bytes.
+    """
+
+    def __init__(self, fixtures: Fixtures) -> None:
+        self.fixtures = fixtures
+        self.requests: dict[str, int] = {}
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.websockets: list[socket.socket] = []
+        self.compressed: dict[bytes, bytes] = {}
+        self.fixtures_changed()
+
+        self.http = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.http.daemon_threads = True
+        self.port = self.http.server_port
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+
+    def fixtures_changed(self) -> None:
+        """Encode channel list and members again, after fixtures are modified"""
+        # Channels (and members) by team, 1-1 chats are listed in every team
+        self.channels_json: dict[str, bytes] = {}
+        self.members_json: dict[str, bytes] = {}
+
+        for team in self.fixtures.teams:
+            channels = [
+                channel
+                for channel in self.fixtures.channels
+                if channel["team_id"] in ("", team["id"])
+            ]
+            channel_ids = {channel["id"] for channel in channels}
+            self.channels_json[team["id"]] = json.dumps(channels).encode()
+            self.members_json[team["id"]] = json.dumps(
+                [
+                    member
+                    for member in self.fixtures.members
+                    if member["channel_id"] in channel_ids
+                ]
+            ).encode()
+
+        last_post_at = max(
+            (channel["last_post_at"] for channel in self.fixtures.channels), default=0
+        )
+        self.etag = f'"{len(self.fixtures.channels)}.{last_post_at}"'
+        self.compressed = {}
+
+    def gzip(self, body: bytes) -> bytes:
+        """Compressed body, large bodies are only compressed once"""
+        if body in self.compressed:
+            return self.compressed[body]
+
+        data = gzip.compress(body)
+
+        if len(body) > 65536:
+            self.compressed[body] = data
+
+        return data
+
+    def drop_websockets(self) -> None:
+        """Drop all websocket connections, without a close frame"""
+        with self.lock:
+            connections = self.websockets
+            self.websockets = []
+
+        for connection in connections:
+            connection.shutdown(socket.SHUT_RDWR)
+
+    def handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        routes: list[tuple[str, str, Any]] = [
+            ("POST", r"/api/v4/users/login", server.login),
+            ("POST", r"/api/v4/users/ids", server.users_by_ids),
+            ("GET", r"/api/v4/users/username/(?P<username>[^/]+)", server.user_by_name),
+            ("GET", r"/api/v4/users/(?P<user_id>[^/]+)/teams", server.teams),
+            (
+                "GET",
+                r"/api/v4/users/(?P<user_id>[^/]+)/teams/(?P<team_id>[^/]+)/channels",
+                server.channels,
+            ),
+            (
+                "GET",
+                r"/api/v4/users/(?P<user_id>[^/]+)/teams/(?P<team_id>[^/]+)/channels/members",
+                server.members,
+            ),
+            ("GET", r"/api/v4/users/(?P<user_id>[^/]+)", server.user),
+            ("GET", r"/api/v4/channels/(?P<channel_id>[^/]+)/posts", server.posts),
+        ]
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, avoid delayed ACK stalls
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+            def respond(
+                self,
+                status: int,
+                body: bytes = b"",
+                headers: dict[str, str] | None = None,
+            ) -> None:
+                if len(body) > 1024 and "gzip" in (
+                    self.headers.get("Accept-Encoding") or ""
+                ):
+                    body = server.gzip(body)
+                    headers = {**(headers or {}), "Content-Encoding": "gzip"}
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+                with server.lock:
+                    server.bytes_sent += len(body)
+
+            def dispatch(self, method: str) -> None:
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"null")
+
+                for route_method, pattern, func in routes:
+                    match = re.fullmatch(pattern, url.path)
+                    if route_method != method or not match:
+                        continue
+
+                    with server.lock:
+                        server.requests[pattern] = server.requests.get(pattern, 0) + 1
+
+                    if func != server.login and (
+                        self.headers.get("Authorization") != f"Bearer {TOKEN}"
+                    ):
+                        self.respond(401, b'{"message": "Invalid or expired session"}')
+                        return
+
+                    (status, data, headers) = func(
+                        self.headers, parse_qs(url.query), body, **match.groupdict()
+                    )
+                    self.respond(status, data, headers)
+                    return
+
+                self.respond(404, b'{"message": "Not found"}')
+
+            def do_GET(self) -> None:
+                if urlparse(self.path).path == "/api/v4/websocket":
+                    server.websocket(self)
+                    self.close_connection = True
+                    return
+                self.dispatch("GET")
+
+            def do_POST(self) -> None:
+                self.dispatch("POST")
+
+        return Handler
+
+    def login(self, headers: Any, query: Any, body: Any) -> Any:
+        if body.get("login_id") != USERNAME:
+            return (401, b'{"message": "Invalid login"}', None)
+        return (
+            200,
+            json.dumps(self.fixtures.users[USER_ID]).encode(),
+            {"Token": TOKEN},
+        )
+
+    def user(self, headers: Any, query: Any, body: Any, user_id: str) -> Any:
+        if user_id == "me":
+            user_id = USER_ID
+        if user_id not in self.fixtures.users:
+            return (404, b'{"message": "Not found"}', None)
+        return (200, json.dumps(self.fixtures.users[user_id]).encode(), None)
+
+    def user_by_name(self, headers: Any, query: Any, body: Any, username: str) -> Any:
+        for user in self.fixtures.users.values():
+            if user["username"] == username:
+                return (200, json.dumps(user).encode(), None)
+        return (404, b'{"message": "Not found"}', None)
+
+    def users_by_ids(self, headers: Any, query: Any, body: Any) -> Any:
+        users = [self.fixtures.users[i] for i in body if i in self.fixtures.users]
+        return (200, json.dumps(users).encode(), None)
+
+    def teams(self, headers: Any, query: Any, body: Any, user_id: str) -> Any:
+        return (200, json.dumps(self.fixtures.teams).encode(), None)
+
+    def channels(
+        self, headers: Any, query: Any, body: Any, user_id: str, team_id: str
+    ) -> Any:
+        if headers.get("If-None-Match") == self.etag:
+            return (304, b"", {"ETag": self.etag})
+        return (200, self.channels_json[team_id], {"ETag": self.etag})
+
+    def members(
+        self, headers: Any, query: Any, body: Any, user_id: str, team_id: str
+    ) -> Any:
+        return (200, self.members_json[team_id], None)
+
+    def posts(self, headers: Any, query: Any, body: Any, channel_id: str) -> Any:
+        since = int(query.get("since", ["0"])[0])
+        posts = [
+            post
+            for post in self.fixtures.posts.get(channel_id, [])
+            if post["update_at"] > since
+        ]
+        return (
+            200,
+            json.dumps(
+                {
+                    "order": [post["id"] for post in reversed(posts)],
+                    "posts": {post["id"]: post for post in posts},
+                }
+            ).encode(),
+            None,
+        )
+
+    def websocket(self, handler: BaseHTTPRequestHandler) -> None:
+        """Websocket, replaying fixtures.events to every client"""
+        key = handler.headers["Sec-WebSocket-Key"]
+        accept = base64.b64encode(
+            hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()
+        ).decode()
+
+        handler.send_response(101)
+        handler.send_header("Upgrade", "websocket")
+        handler.send_header("Connection", "Upgrade")
+        handler.send_header("Sec-WebSocket-Accept", accept)
+        handler.end_headers()
+        handler.wfile.flush()
+
+        (opcode, challenge) = read_frame(handler.rfile)
+        if json.loads(challenge).get("data", {}).get("token") != TOKEN:
+            write_frame(handler.wfile, 0x8, b"")
+            return
+
+        with self.lock:
+            self.websockets.append(handler.connection)
+
+        try:
+            self.websocket_events(handler)
+        finally:
+            with self.lock:
+                if handler.connection in self.websockets:
+                    self.websockets.remove(handler.connection)
+
+    def websocket_events(self, handler: BaseHTTPRequestHandler) -> None:
+        """Send hello and events, and keep connection open until the client disconnects"""
+        hello = {
+            "event": "hello",
+            "data": {"connection_id": uuid.uuid4().hex},
+            "seq": 0,
+        }
+        write_frame(handler.wfile, 0x1, json.dumps(hello).encode())
+        for event in self.fixtures.events:
+            write_frame(handler.wfile, 0x1, event.encode())
+        handler.wfile.flush()
+
+        while True:
+            try:
+                (opcode, payload) = read_frame(handler.rfile)
+            except (OSError, struct.error):
+                return
+
+            if opcode == 0x8:
+                write_frame(handler.wfile, 0x8, payload[:2])
+                handler.wfile.flush()
+                return
+            if opcode == 0x9:
+                write_frame(handler.wfile, 0xA, payload)
+                handler.wfile.flush()
+
+    def shutdown(self) -> None:
+        self.http.shutdown()
+        self.http.server_close()
+
+
+def read_frame(rfile: Any) -> tuple[int, bytes]:
+    """Read one (masked) websocket frame from client"""
+    (first, second) = struct.unpack("!BB", rfile.read(2))
+    length = second & 0x7F
+    if length == 126:
+        (length,) = struct.unpack("!H", rfile.read(2))
+    elif length == 127:
+        (length,) = struct.unpack("!Q", rfile.read(8))
+    mask = rfile.read(4) if second & 0x80 else b"\0\0\0\0"
+    payload = rfile.read(length)
+    return (first & 0x0F, bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+
+
+def write_frame(wfile: Any, opcode: int, payload: bytes) -> None:
+    """Write one (unmasked) websocket frame to client"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    wfile.write(header + payload)
+
+
+class FakeApi:
+    """Stand-in for the mattermost driver, returns fixtures"""
+
+    def __init__(self, fixtures: Fixtures) -> None:
+        # Responses are decoded from json on every request, as in the driver
+        self.channels_json = json.dumps(fixtures.channels)
+        self.members_json = json.dumps(fixtures.members)
+        self.channels_bytes = self.channels_json.encode()
+        self.members_bytes = self.members_json.encode()
+        self.channels = self
+        self.client = self
+
+    def get_channel_members_for_user(self, user_id: str, team_id: str) -> Any:
+        return json.loads(self.members_json)
+
+    def get_if_none_match(self, endpoint: str, etag: str | None) -> Any:
+        return (json.loads(self.channels_json), "etag")
+
+    def iter_if_none_match(self, endpoint: str, etag: str | None = None) -> Any:
+        # Streamed responses are decoded from chunks, as read from the socket
+        body = (
+            self.members_bytes if endpoint.endswith("/members") else self.channels_bytes
+        )
+        chunks = (
+            body[pos : pos + CHUNK_SIZE] for pos in range(0, len(body), CHUNK_SIZE)
+        )
+        return (jsonstream.iter_array(chunks), "etag")
+
+
+class FakeMattermost:
+    """Stand-in for Mattermost, without any server"""
+
+    def __init__(self, fixtures: Fixtures) -> None:
+        self.api = FakeApi(fixtures)
+        self.user = User(**fixtures.users[USER_ID])
+        self.channels = Channels()
+        self.executor = ThreadPoolExecutor(2)
+
+    def resolve_users(self, user_ids: Iterable[str]) -> None:
+        pass
+
+    def get_user(self, user_id: str) -> str:
+        return user_id[-4:]
+
+    def save_channel_cache(self) -> None:
+        pass
@@ -0,0 +1,108 @@
+"""
+Benchmark channel filtering (render.summarize) for 100, 1k and 10k
+unread channels
+
+Compares the previous implementation, that searched the `ignore` regular
+expression (twice) for every channel on every poll, with channel rules:
+the first poll evaluates all rules, following polls use the cached verdicts.
+
+    python benchmarks/rules.py [--rules 30]
+"""
+
+import argparse
+import re
+import time
+from collections.abc import Callable
+
+from fakeserver import Fixtures
+
+from mmtools import render, rules
+from mmtools.channel import Channel
+
+IGNORE = "^(off-topic|random|social)-"
+
+
+def channel_rules(count: int) -> str:
+    """
+    count rules, matching on all fields. Exceptions (include) first, then
+    exclude rules. Most channels match no rule
+    """
+    fields = [
+        "exclude id={n:026d}",
+        "exclude team=team-{n}",
+        "exclude name=^project-{n}-archive",
+    ]
+    includes = [f"include name=^important-{n}$" for n in range(count // 4)]
+    excludes = [
+        fields[n % len(fields)].format(n=n) for n in range(count - len(includes))
+    ]
+    return "\n".join(includes + excludes)
+
+
+def legacy_split(channels: list[Channel], ignore: str) -> tuple[list[str], list[str]]:
+    """Filtering and grouping of channels before channel rules"""
+    private = [
+        f"{channel.display_name}:{channel.msg_unread_count}"
+        for channel in channels
+        if channel.msg_unread_count
+        and channel.type == "D"
+        and not (ignore and re.search(ignore, channel.name))
+    ]
+    other = [
+        f"{channel.display_name}:{channel.msg_unread_count}"
+        for channel in channels
+        if channel.msg_unread_count
+        and channel.type != "D"
+        and not (ignore and re.search(ignore, channel.name))
+    ]
+
+    return (private, other)
+
+
+def measure(func: Callable[[], object], repeat: int) -> float:
+    """Best seconds per call"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rules", type=int, default=30)
+    options = parser.parse_args()
+
+    teams = Fixtures.create(channels=0, users=0, teams=10).teams
+    parsed = rules.parse(channel_rules(options.rules), IGNORE)
+
+    print(f"{'channels':>8} {'impl':>16} {'per poll':>10}")
+    for count in (100, 1000, 10000):
+        # All channels unread
+        channels = Fixtures.create(
+            channels=count, users=100, unread=1, teams=len(teams)
+        ).unread_channels()
+
+        def first_poll(channels: list[Channel] = channels) -> object:
+            shown = rules.ChannelFilter(parsed, lambda: teams)
+            return render.summarize(channels, shown)
+
+        cached = rules.ChannelFilter(parsed, lambda: teams)
+        render.summarize(channels, cached)
+
+        repeat = max(10, 100000 // count)
+        for name, func in (
+            ("legacy (1 regex)", lambda c=channels: legacy_split(c, IGNORE)),
+            (f"{len(parsed)} rules, first", first_poll),
+            (
+                f"{len(parsed)} rules, cached",
+                lambda c=channels, f=cached: render.summarize(c, f),
+            ),
+        ):
+            seconds = measure(func, repeat)
+            print(f"{count:>8} {name:>16} {seconds * 1000:>8.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
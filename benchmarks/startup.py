@@ -0,0 +1,129 @@
+"""
+Benchmark startup of the one-shot status tools (mmstatus/mmwaybar)
+
+Runs every variant as a new process, as the status bar does, with a fake
+mmwatch serving the unread state, and measures wall time per invocation:
+
+- python: the bare interpreter, for reference
+- full: the full status tool (caep, pydantic, requests, mattermostdriver)
+- fast: the fast start path (cached config, state from mmwatch)
+
+The password is given as a pass entry, which would fail if gpg was run.
+With --importtime the slowest imports of the fast start path are listed.
+
+    python benchmarks/startup.py [--repeat 20] [--importtime]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from fakeserver import Fixtures
+
+import mmtools
+from mmtools import daemon
+from mmtools.channel import Channel
+
+SERVER = "mattermost.example.com"
+USER = "benchmark"
+
+ARGS = [
+    "--server",
+    SERVER,
+    "--user",
+    USER,
+    "--password-pass-entry",
+    "mattermost/benchmark",
+    "--loglevel",
+    "error",
+]
+
+VARIANTS = {
+    "python": "pass",
+    "full": "from mmtools.status import i3blocks; i3blocks()",
+    "fast": "from mmtools.faststart import i3blocks; i3blocks()",
+}
+
+
+def serve(path: Path, channels: list[Channel]) -> None:
+    """Serve state on path, as mmwatch does (in a background thread)"""
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(daemon.start_server(path, lambda: channels))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+
+def run(code: str, *options: str) -> tuple[float, str]:
+    """Run code in a new interpreter, returns (seconds, stdout)"""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, *options, "-c", code, *ARGS],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return (time.perf_counter() - start, result.stdout)
+
+
+def importtime(code: str, top: int) -> None:
+    """Print the slowest imports (cumulative) of code"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code, *ARGS],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+
+    imports = []
+    for line in stderr.splitlines()[1:]:
+        (_, cumulative, name) = line.split("|")
+        imports.append((int(cumulative), name.rstrip()))
+
+    for microseconds, name in sorted(imports, reverse=True)[:top]:
+        print(f"{microseconds / 1000:>8.1f}ms {name}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--importtime", action="store_true")
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        # Do not use config/cache from the user running the benchmark
+        os.environ["HOME"] = home
+        for name in ("XDG_CONFIG_HOME", "XDG_CACHE_HOME", "XDG_RUNTIME_DIR"):
+            os.environ[name] = str(Path(home) / name.lower())
+        os.environ["PYTHONPATH"] = str(Path(mmtools.__file__).parents[1])
+
+        # All channels unread
+        channels = Fixtures.create(
+            channels=options.channels, users=options.channels, unread=1
+        ).unread_channels()
+        serve(daemon.socket_path(SERVER, 443, USER), channels)
+
+        # First invocation caches the parsed config
+        (_, full_output) = run(VARIANTS["full"])
+        (_, fast_output) = run(VARIANTS["fast"])
+        assert full_output == fast_output, (full_output, fast_output)
+
+        for name, code in VARIANTS.items():
+            timings = [run(code)[0] for _ in range(options.repeat)]
+            print(
+                f"{name:>8} min {min(timings) * 1000:>7.1f}ms "
+                f"median {statistics.median(timings) * 1000:>7.1f}ms"
+            )
+
+        if options.importtime:
+            importtime(VARIANTS["fast"], 15)
+
+
+if __name__ == "__main__":
+    main()
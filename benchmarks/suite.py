@@ -0,0 +1,297 @@
+"""
+Benchmark suite, running mmtools against a local fake Mattermost server
+
+For 10, 1k and 10k channels/users it measures:
+
+- end-to-end latency of i3blocks() and waybar(), cold (first invocation,
+  with login) and warm (session/channel/user cache from previous invocation)
+- requests and bytes transferred per invocation
+- peak memory (tracemalloc) of one warm invocation
+- mmwatch event throughput over the websocket
+- mmwatch reconnect: time from a dropped websocket until posts missed while
+  disconnected are replayed, and the requests needed
+
+Results are printed, and written as json with --output so that runs can
+be compared.
+
+    python benchmarks/suite.py [--sizes 10,1000,10000] [--output result.json]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+from fakeserver import USERNAME, FakeServer, Fixtures
+
+from mmtools import status
+from mmtools.mattermost import Mattermost
+
+
+def run_entry_point(
+    entry_point: Callable[[], None], server: FakeServer, *args: str
+) -> str:
+    """Run entry point with command line arguments, return stdout"""
+    sys.argv = [
+        entry_point.__name__,
+        "--server",
+        "127.0.0.1",
+        "--port",
+        str(server.port),
+        "--scheme",
+        "http",
+        "--user",
+        USERNAME,
+        "--password",
+        "benchmark",
+        "--loglevel",
+        "error",
+        "--no-daemon",
+        *args,
+    ]
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            entry_point()
+        except SystemExit:
+            pass
+    return output.getvalue()
+
+
+def measure_entry_point(
+    entry_point: Callable[[], None], server: FakeServer, repeat: int
+) -> dict[str, Any]:
+    """Measure cold and warm invocations of entry point"""
+    with tempfile.TemporaryDirectory() as cache_home:
+        os.environ["XDG_CACHE_HOME"] = cache_home
+
+        server.requests.clear()
+        server.bytes_sent = 0
+        start = time.perf_counter()
+        run_entry_point(entry_point, server)
+        cold = time.perf_counter() - start
+        cold_requests = sum(server.requests.values())
+        cold_bytes = server.bytes_sent
+
+        server.requests.clear()
+        server.bytes_sent = 0
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = run_entry_point(entry_point, server)
+            timings.append(time.perf_counter() - start)
+
+        warm_requests = sum(server.requests.values()) / repeat
+        warm_bytes = server.bytes_sent / repeat
+
+        tracemalloc.start()
+        run_entry_point(entry_point, server)
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "cold_seconds": cold,
+        "cold_requests": cold_requests,
+        "cold_bytes": cold_bytes,
+        "warm_seconds_median": statistics.median(timings),
+        "warm_seconds_min": min(timings),
+        "warm_requests": warm_requests,
+        "warm_bytes": warm_bytes,
+        "warm_peak_memory_bytes": peak,
+        "output_bytes": len(output),
+    }
+
+
+def measure_watch(server: FakeServer, events: int) -> dict[str, Any]:
+    """Measure mmwatch event throughput over the websocket"""
+    # Imported here, since notify2 requires dbus
+    from mmtools.watch import Config, EventHandler
+
+    server.fixtures.create_events(events)
+
+    with tempfile.TemporaryDirectory() as cache_home:
+        os.environ["XDG_CACHE_HOME"] = cache_home
+
+        args = Config(
+            server="127.0.0.1",
+            port=server.port,
+            scheme="http",
+            user=USERNAME,
+            password="benchmark",
+            ignore=None,
+            channel_rules=None,
+            logfile=None,
+            team=None,
+            password_pass_entry=None,
+            metrics_file=None,
+            profile_output=None,
+            accounts=None,
+            socket=None,
+        )
+        mm = Mattermost(args)
+        mm.init_channels()
+        handler = EventHandler(mm, None, "", True, "")
+
+        received = 0
+        start = 0.0
+
+        async def event_handler(event: str) -> None:
+            nonlocal received, start
+            if not received:
+                # hello, sent before the replayed events
+                start = time.perf_counter()
+            else:
+                await handler.event_handler(event)
+            received += 1
+            if received > events:
+                mm.api.disconnect()
+
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        mm.init_websocket(event_handler)
+        seconds = time.perf_counter() - start
+
+    return {
+        "events": events,
+        "seconds": seconds,
+        "events_per_second": events / seconds,
+        "unread_channels": len(mm.channels.channels),
+    }
+
+
+def measure_reconnect(server: FakeServer, posts: int) -> dict[str, Any]:
+    """
+    Measure mmwatch reconnect: the websocket is dropped, posts are added while
+    disconnected, and mmwatch reconnects and replays the missed posts
+    """
+    from mmtools.watch import Config, EventHandler
+
+    server.fixtures.create_events(0)
+
+    with tempfile.TemporaryDirectory() as cache_home:
+        os.environ["XDG_CACHE_HOME"] = cache_home
+
+        args = Config(
+            server="127.0.0.1",
+            port=server.port,
+            scheme="http",
+            user=USERNAME,
+            password="benchmark",
+            ignore=None,
+            channel_rules=None,
+            logfile=None,
+            team=None,
+            password_pass_entry=None,
+            metrics_file=None,
+            profile_output=None,
+            accounts=None,
+            socket=None,
+            backoff_initial=0.1,
+        )
+        mm = Mattermost(args)
+        mm.init_channels()
+        handler = EventHandler(mm, None, "", True, "")
+
+        dropped = 0.0
+        replayed = 0
+
+        def drop() -> None:
+            nonlocal dropped
+            server.requests.clear()
+            server.bytes_sent = 0
+            dropped = time.perf_counter()
+            server.drop_websockets()
+            server.fixtures.add_posts(posts)
+            server.fixtures_changed()
+
+        async def event_handler(event: str) -> None:
+            nonlocal replayed
+            if '"replayed"' in event:
+                replayed += 1
+                await handler.event_handler(event)
+            elif '"hello"' in event and not dropped:
+                threading.Timer(0.1, drop).start()
+
+            if replayed == posts:
+                mm.api.disconnect()
+
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        mm.init_websocket(event_handler)
+        seconds = time.perf_counter() - dropped
+
+    return {
+        "posts": posts,
+        "replayed": replayed,
+        "seconds": seconds,
+        "requests": sum(server.requests.values()),
+        "bytes": server.bytes_sent,
+        "unread_channels": len(mm.channels.channels),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", default="10,1000,10000")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--posts", type=int, default=50)
+    parser.add_argument("--no-watch", action="store_true", help="Skip mmwatch")
+    parser.add_argument("--output", help="Write results as json to file")
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        # Do not use config/cache from the user running the benchmark
+        os.environ["HOME"] = home
+        os.environ["XDG_CONFIG_HOME"] = str(Path(home) / "config")
+        os.environ.pop("XDG_RUNTIME_DIR", None)
+
+        results: dict[str, Any] = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.time(),
+            "sizes": {},
+        }
+
+        for size in (int(size) for size in options.sizes.split(",")):
+            server = FakeServer(Fixtures.create(channels=size, users=size))
+            result = {
+                "i3blocks": measure_entry_point(
+                    status.i3blocks, server, options.repeat
+                ),
+                "waybar": measure_entry_point(status.waybar, server, options.repeat),
+            }
+            if not options.no_watch:
+                result["mmwatch"] = measure_watch(server, options.events)
+                result["reconnect"] = measure_reconnect(server, options.posts)
+            server.shutdown()
+
+            results["sizes"][size] = result
+
+            for name, values in result.items():
+                print(
+                    f"{size:>6} {name:<10}"
+                    + " ".join(
+                        f"{key}={value:.4g}"
+                        for key, value in values.items()
+                        if isinstance(value, int | float)
+                    ),
+                    file=sys.stderr,
+                )
+
+    if options.output:
+        Path(options.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
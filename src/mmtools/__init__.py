@@ -0,0 +1,4 @@
+"""mmtools"""
+
+CONFIG_ID = "mmtools"
+CONFIG_NAME = "config"
@@ -1,22 +1,27 @@
 """mmblocks"""
 
-import logging
-import logging.handlers
 import os
-import socket
 import sys
 from logging import error, info
 from pathlib import Path
-from typing import Any, cast
+from typing import TYPE_CHECKING, Any, TextIO, cast
 
 import caep
-import passpy
-import requests
-from pydantic import BaseModel, Field, SecretStr, model_validator
-from urllib3.exceptions import InsecureRequestWarning
+from pydantic import (
+    BaseModel,
+    Field,
+    SecretStr,
+    ValidationError,
+    ValidationInfo,
+    field_validator,
+    model_validator,
+)
 
-CONFIG_ID = "mmtools"
-CONFIG_NAME = "config"
+from mmtools import CONFIG_ID, faststart, metrics, profiling, rules
+from mmtools.log import setup_logging
+
+if TYPE_CHECKING:
+    import passpy
 
 
 class ArgumentError(Exception):
@@ -36,8 +41,11 @@ def fatal(message: str, exit_code: int = 1) -> None:
     sys.exit(exit_code)
 
 
-def passpy_store(gpgbinary: str | None = None) -> passpy.store.Store:
+def passpy_store(gpgbinary: str | None = None) -> "passpy.store.Store":
     """passpy store"""
+    # Imported here, since passpy (and git) is slow to import
+    import passpy
+
     if not gpgbinary:
         gpgbinary = whereis(["gpg2", "gpg"])
         if not gpgbinary:
@@ -69,48 +77,15 @@ def gettpassentry(key: str) -> Any:
         return entry.split("\n")[0]
 
 
-def setup_logging(
-    loglevel: str = "debug",
-    logfile: str | None = None,
-    prefix: str = "mmtools",
-    maxBytes: int = 10000000,  # 10 MB
-    backupCount: int = 5,
-) -> None:
-    """Setup loglevel and optional log to file"""
-    numeric_level = getattr(logging, loglevel.upper(), None)
-    if not isinstance(numeric_level, int):
-        raise ValueError(f"Invalid log level: {loglevel}")
-
-    datefmt = "%Y-%m-%d %H:%M:%S"
-    formatter = "[%(asctime)s] app=" + prefix + " level=%(levelname)s msg=%(message)s"
-
-    if logfile:
-        logdir = Path(logfile).parent
-
-        if not logdir.is_dir():
-            logdir.mkdir(parents=True)
-
-        # Support strftime in log file names
-        handlers = [
-            logging.handlers.RotatingFileHandler(
-                logfile, maxBytes=maxBytes, backupCount=backupCount
-            )
-        ]
-
-        logging.basicConfig(
-            level=numeric_level, handlers=handlers, format=formatter, datefmt=datefmt
-        )
-    else:
-        logging.basicConfig(
-            level=numeric_level, stream=sys.stdout, format=formatter, datefmt=datefmt
-        )
-
-
 class Config(BaseModel):
     server: str = Field(description="Mattermost Server")
     user: str = Field(description="Mattermost User")
     port: int = Field(443, description="Mattermost port")
+    scheme: str = Field("https", description="Mattermost scheme (https/http)")
     ignore: str | None = Field(description="Regular expression of channels to ignore")
+    channel_rules: str | None = Field(
+        description="Rules to include/exclude channels by id, type, team or name, separated by ';' (see README)"
+    )
     no_verify: bool = Field(False, description="SSL verify")
     logfile: str | None = Field(description="Log to file")
     loglevel: str = Field("info", description="Log level (default=INFO)")
@@ -123,6 +98,53 @@ class Config(BaseModel):
     password_pass_entry: str | None = Field(
         description="pass entry to insert into password"
     )
+    no_session_cache: bool = Field(
+        False, description="Do not cache session token between invocations"
+    )
+    session_ttl: int = Field(
+        86400, description="Max age (seconds) of cached session token"
+    )
+    no_channel_cache: bool = Field(
+        False, description="Do not cache channel state between invocations"
+    )
+    full_resync: int = Field(
+        10, description="Fetch full channel list every N updates (0=never)"
+    )
+    user_cache_ttl: int = Field(
+        7 * 86400, description="Max age (seconds) of cached usernames"
+    )
+    unknown_user_ttl: int = Field(
+        3600, description="Max age (seconds) of cached unknown user ids"
+    )
+    socket: str | None = Field(
+        description="Unix socket where mmwatch serves unread state (default: $XDG_RUNTIME_DIR/mmtools/<id>.sock)"
+    )
+    no_daemon: bool = Field(
+        False,
+        description="Do not serve (mmwatch) or read (status tools) unread state on unix socket",
+    )
+    backoff_initial: float = Field(
+        1.0, description="Seconds to wait before reconnecting after the first failure"
+    )
+    backoff_max: float = Field(
+        60.0,
+        description="Max seconds to wait before reconnecting (exponential backoff)",
+    )
+    metrics_port: int = Field(
+        0, description="Serve Prometheus metrics on 127.0.0.1:<port> (0=disabled)"
+    )
+    metrics_file: str | None = Field(
+        description="Write Prometheus metrics to file (node exporter textfile collector)"
+    )
+    profile: bool = Field(
+        False, description="Print timing of the phases of one status poll to stderr"
+    )
+    profile_output: str | None = Field(
+        description="Write profile to file, speedscope (<file>.json) or pstats (other names)"
+    )
+    accounts: str | None = Field(
+        description="Additional accounts, comma separated names of [account:<name>] config sections"
+    )
 
     @model_validator(mode="before")
     def check_arguments(cls, values: dict[str, Any]) -> dict[str, Any]:
@@ -133,23 +155,106 @@ class Config(BaseModel):
 
         return values
 
+    @field_validator("ignore", "channel_rules")
+    def check_rules(cls, value: str | None, info: ValidationInfo) -> str | None:
+        if info.field_name == "ignore":
+            rules.parse(None, value)
+        else:
+            rules.parse(value)
+
+        return value
+
+
+# Options set per account in [account:<name>] sections. Other options are
+# the same as for the main account
+ACCOUNT_FIELDS = (
+    "server",
+    "user",
+    "port",
+    "scheme",
+    "no_verify",
+    "password",
+    "password_pass_entry",
+    "team",
+    "ignore",
+    "channel_rules",
+    "socket",
+)
+
+# Config of additional accounts (--accounts) by name, loaded by handle_args
+ACCOUNTS: dict[str, Config] = {}
+
+
+def load_accounts(args: Config, config_name: str) -> dict[str, Config]:
+    """
+    Config of additional accounts, from [account:<name>] sections in the
+    config file. The sections inherit [DEFAULT], as the sections of the tools
+    do. Raises ArgumentError if a section is missing or invalid
+    """
+    if not args.accounts:
+        return {}
+
+    (parser, _) = caep.config.load_ini(CONFIG_ID, config_name)
+    model = type(args)
+    shared = args.model_dump(exclude=set(ACCOUNT_FIELDS))
+    unset = {
+        field: None
+        for field in ACCOUNT_FIELDS
+        if model.model_fields[field].is_required()
+    }
+
+    accounts = {}
+
+    for name in (name.strip() for name in args.accounts.split(",")):
+        section = f"account:{name}"
+
+        if not name:
+            continue
+
+        if not parser or not parser.has_section(section):
+            raise ArgumentError(f"Account not found in config: [{section}]")
+
+        values = {
+            key.replace("-", "_"): value
+            for (key, value) in parser.items(section)
+            if value and key.replace("-", "_") in ACCOUNT_FIELDS
+        }
+
+        try:
+            accounts[name] = model.model_validate(
+                {**shared, **unset, **values, "accounts": None}
+            )
+        except (ArgumentError, ValidationError) as e:
+            raise ArgumentError(f"[{section}]: {e}") from e
 
-def handle_args(model: type[caep.schema.BaseModelType], section: str) -> Config:
-    """Verify default arguments"""
+    return accounts
 
-    hostname = socket.gethostname()
-    hostname_short = socket.gethostname().split(".")[0]
 
-    host_config_name = f"{CONFIG_NAME}-{hostname}"
-    host_short_config_name = f"{CONFIG_NAME}-{hostname_short}"
+def get_password(args: Config) -> str:
+    """
+    Get password. The pass entry is only decrypted when the password is
+    actually needed (login), so gpg is not run while a cached session is valid
+    """
+    if args.password_pass_entry:
+        args.password = SecretStr(gettpassentry(args.password_pass_entry))
+        args.password_pass_entry = None
 
-    if (Path(caep.get_config_dir(CONFIG_ID)) / host_config_name).is_file():
-        config_name = host_config_name
+    return cast(SecretStr, args.password).get_secret_value()
 
-    elif (Path(caep.get_config_dir(CONFIG_ID)) / host_short_config_name).is_file():
-        config_name = host_short_config_name
-    else:
-        config_name = CONFIG_NAME
+
+def handle_args(
+    model: type[caep.schema.BaseModelType],
+    section: str,
+    log_stream: TextIO = sys.stdout,
+) -> Config:
+    """Verify default arguments"""
+
+    config_dir = Path(caep.get_config_dir(CONFIG_ID))
+
+    # Use host specific config if it exists, the last name is the default
+    for config_name in faststart.config_names():
+        if (config_dir / config_name).is_file():
+            break
 
     try:
         args: Config = cast(
@@ -162,10 +267,15 @@ def handle_args(model: type[caep.schema.BaseModelType], section: str) -> Config:
                 section,
             ),
         )
+        ACCOUNTS.update(load_accounts(args, config_name))
     except ArgumentError as e:
         fatal(str(e))
 
-    setup_logging(args.loglevel, args.logfile)
+    setup_logging(args.loglevel, args.logfile, stream=log_stream)
+    metrics.setup(args.metrics_port, args.metrics_file)
+
+    if args.profile or args.profile_output:
+        profiling.setup(Path(sys.argv[0]).name, args.profile_output)
 
     info(f"args: {args}")
     info(f"config: {CONFIG_ID}/{config_name}")
@@ -178,15 +288,11 @@ def handle_args(model: type[caep.schema.BaseModelType], section: str) -> Config:
     if not args.user:
         fatal("--user not specified")
 
-    if args.no_verify:
-        requests.packages.urllib3.disable_warnings(  # type: ignore
-            category=InsecureRequestWarning
-        )
+    if args.no_verify or any(account.no_verify for account in ACCOUNTS.values()):
+        import urllib3
 
-    if args.password_pass_entry:
-        args.password = SecretStr(gettpassentry(args.password_pass_entry))
+        urllib3.disable_warnings(category=urllib3.exceptions.InsecureRequestWarning)
 
-    if not args.password:
-        fatal("Must specify either --password or --password-pass-entry")
+    faststart.save_config(section, args, ACCOUNTS)
 
     return args
@@ -0,0 +1,196 @@
+"""mmtools - local event broker
+
+With --broker, mmwatch publishes the websocket events it receives on a unix
+socket next to the state socket (<id>.events.sock), so scripts and other
+tools can react to events without opening their own authenticated websocket.
+
+Every subscriber gets the decoded events as one line of json per event.
+Events in channels hidden by the channel rules are not published. A
+subscriber can limit the events it gets by sending a line of event types
+(separated by space or comma), at any time.
+
+Every subscriber has a bounded buffer. If a subscriber does not keep up,
+the oldest events are dropped, and it gets an event of type
+`mmtools_dropped` with the number of dropped events. A slow subscriber
+never blocks mmwatch.
+
+mmevents prints the events published by a running mmwatch.
+"""
+
+import asyncio
+import json
+import socket
+import sys
+from collections import deque
+from logging import debug, info, warning
+from pathlib import Path
+from typing import Any, cast
+
+from pydantic import Field
+
+from mmtools import arguments, daemon, metrics
+
+
+def events_path(server: str, port: int, user: str, path: str | None = None) -> Path:
+    """Path to event socket, next to the state socket"""
+    return daemon.socket_path(server, port, user, path).with_suffix(".events.sock")
+
+
+def event_types(value: str) -> set[str]:
+    """Event types from space or comma separated list (empty: all events)"""
+    return set(value.replace(",", " ").split())
+
+
+class Subscriber:
+    """Connected subscriber, with a bounded buffer of events"""
+
+    def __init__(self, writer: asyncio.StreamWriter, max_events: int) -> None:
+        self.writer = writer
+        self.buffer: deque[bytes] = deque(maxlen=max_events)
+        self.types: set[str] = set()
+        self.dropped = 0
+        self.ready = asyncio.Event()
+
+    def put(self, event_type: str, line: bytes) -> None:
+        """Add event to buffer, the oldest event is dropped if it is full"""
+        if self.types and event_type not in self.types:
+            return
+
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+            metrics.inc("mmtools_broker_dropped_total")
+
+        self.buffer.append(line)
+        self.ready.set()
+
+    async def send(self) -> None:
+        """Send buffered events until the subscriber disconnects"""
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+
+                if self.dropped:
+                    dropped = {
+                        "event": "mmtools_dropped",
+                        "data": {"count": self.dropped},
+                    }
+                    self.writer.write(json.dumps(dropped).encode() + b"\n")
+                    self.dropped = 0
+
+                while self.buffer:
+                    self.writer.write(self.buffer.popleft())
+
+                # New events are buffered (or dropped) while waiting
+                await self.writer.drain()
+        except ConnectionError as e:
+            debug("subscriber disconnected: %s", e)
+
+
+class Broker:
+    """Publish events to subscribers on a unix socket"""
+
+    def __init__(self, max_events: int) -> None:
+        self.max_events = max_events
+        self.subscribers: set[Subscriber] = set()
+        self.server: asyncio.AbstractServer | None = None
+        self.path: Path | None = None
+
+    @property
+    def active(self) -> bool:
+        """True if there are subscribers, events are only encoded if there are"""
+        return bool(self.subscribers)
+
+    def publish(self, event: dict[str, Any]) -> None:
+        """Publish decoded event to all subscribers"""
+        event_type = event.get("event") or ""
+        line = json.dumps(event).encode() + b"\n"
+
+        for subscriber in self.subscribers:
+            subscriber.put(event_type, line)
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Serve subscriber until it disconnects"""
+        subscriber = Subscriber(writer, self.max_events)
+        self.subscribers.add(subscriber)
+        sender = asyncio.create_task(subscriber.send())
+
+        debug("subscriber connected (%s subscribers)", len(self.subscribers))
+
+        try:
+            while line := await reader.readline():
+                subscriber.types = event_types(line.decode(errors="replace"))
+                debug("subscribed to %s", subscriber.types or "all events")
+        except ConnectionError as e:
+            debug("subscriber disconnected: %s", e)
+        finally:
+            self.subscribers.discard(subscriber)
+            sender.cancel()
+            writer.close()
+
+    async def start(self, path: Path) -> None:
+        """Start serving on unix socket"""
+        if path.exists():
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(str(path))
+                warning("mmwatch is already publishing events on %s", path)
+                return
+            except ConnectionRefusedError:
+                # Stale socket from a process that did not exit cleanly
+                path.unlink()
+
+        self.server = await asyncio.start_unix_server(self.handle, path=str(path))
+        self.path = path
+        path.chmod(0o600)
+        info("publishing events on %s", path)
+
+    def stop(self) -> None:
+        """Stop server and remove socket"""
+        daemon.stop_server(self.server, self.path or Path())
+        self.server = None
+
+
+class Config(arguments.Config):
+    event_types: str | None = Field(
+        description="Event types to subscribe to, separated by comma (default: all events)"
+    )
+    account: str | None = Field(
+        description="Subscribe to the events of additional account (name)"
+    )
+
+
+def main() -> None:
+    """Print events published by mmwatch (--broker), one line of json per event"""
+    args: Config = cast(Config, arguments.handle_args(Config, "mmstatus"))
+
+    if args.account:
+        if args.account not in arguments.ACCOUNTS:
+            arguments.fatal(f"Unknown account: {args.account}")
+        account: arguments.Config = arguments.ACCOUNTS[args.account]
+    else:
+        account = args
+
+    path = events_path(account.server, account.port, account.user, account.socket)
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(path))
+
+            if args.event_types:
+                sock.sendall(" ".join(event_types(args.event_types)).encode() + b"\n")
+
+            with sock.makefile("rb") as events:
+                for line in events:
+                    sys.stdout.buffer.write(line)
+                    sys.stdout.flush()
+    except (FileNotFoundError, ConnectionRefusedError):
+        arguments.fatal(f"mmwatch is not publishing events on {path} (--broker)")
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""mmtools - on-disk cache"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from collections.abc import Iterator
+from logging import debug, warning
+from pathlib import Path
+from typing import Any
+
+from mmtools import CONFIG_ID
+
+
+def xdg_dir(env_name: str, default: str) -> Path:
+    """
+    Same as caep.get_xdg_dir, which is not used here since importing caep
+    also imports pydantic (too slow for the fast start of the status tools)
+    """
+    return (
+        Path(os.environ.get(env_name, Path(os.environ["HOME"]) / default)) / CONFIG_ID
+    )
+
+
+def cache_dir() -> Path:
+    """Get cache directory, create it with restrictive permissions if missing"""
+    path = xdg_dir("XDG_CACHE_HOME", ".cache")
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return path
+
+
+def digest(*keys: str) -> str:
+    """Short hash of keys, used in file names"""
+    return hashlib.sha256("\0".join(keys).encode()).hexdigest()[:16]
+
+
+def cache_file(name: str, *keys: str) -> Path:
+    """
+    Get path to cache file. The file name is suffixed with a hash of the keys,
+    so the same cache can be used for multiple servers/users
+    """
+    if keys:
+        name = f"{name}-{digest(*keys)}"
+    return cache_dir() / f"{name}.json"
+
+
+def read_json(filename: Path, max_age: float | None = None) -> Any:
+    """
+    Read json from cache file. Returns None if the file does not exist,
+    is not valid json or is older than max_age seconds
+    """
+    try:
+        if max_age is not None and time.time() - filename.stat().st_mtime > max_age:
+            debug("cache expired: %s", filename)
+            return None
+        return json.loads(filename.read_text())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        warning("Unable to read cache %s: %s", filename, e)
+        return None
+
+
+def write_json(filename: Path, data: Any) -> None:
+    """Atomically write json to cache file, only readable by the current user"""
+    tmp = filename.with_name(f".{filename.name}.{os.getpid()}.{threading.get_ident()}")
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        tmp.replace(filename)
+    except OSError as e:
+        warning("Unable to write cache %s: %s", filename, e)
+        tmp.unlink(missing_ok=True)
+
+
+def remove(filename: Path) -> None:
+    """Remove cache file"""
+    filename.unlink(missing_ok=True)
+
+
+@contextlib.contextmanager
+def lock(filename: Path, timeout: float | None) -> Iterator[bool]:
+    """
+    Exclusive lock on filename, released when the context exits (or the
+    process dies). Yields True if the lock is acquired. If another process
+    holds the lock, waits up to timeout seconds (None: until it is released)
+    for it to be released and yields False, without the lock
+    """
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            debug("waiting for lock %s", filename)
+            if timeout is None:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                yield False
+                return
+
+            end = time.monotonic() + timeout
+            while time.monotonic() < end:
+                time.sleep(0.05)
+                try:
+                    # Released by the other process
+                    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    pass
+            yield False
+            return
+
+        yield True
+    finally:
+        os.close(fd)
@@ -0,0 +1,65 @@
+"""mmtools - channel
+
+Channel state, as polled by the status tools and kept up to date by mmwatch
+from websocket events
+"""
+
+from dataclasses import dataclass
+from typing import Any
+
+
+def direct_user(channel_name: str, user_id: str) -> str:
+    """
+    For 1-1 chats, the channel name is "<user_id>__<user_id>" where one of the
+    user ids is yours (probably depends on who opened the private chat) so we need
+    to check which user id is yours, and return the user id of the other user
+    """
+    user1, user2 = channel_name.split("__")
+
+    if user2 == user_id:
+        return user1
+    return user2
+
+
+@dataclass(slots=True)
+class Channel:
+    """
+    Mattermost channel, with only the fields used by mmtools. This is created
+    for every channel the user is member of, so it is kept as light as possible
+    """
+
+    id: str
+    type: str | None = None
+    team_id: str = ""
+    display_name: str | None = None
+    name: str = ""
+    mention_count: int | None = None
+    msg_count: int | None = None
+    total_msg_count: int | None = None
+    update_at: int | None = None
+    last_post_at: int | None = None
+
+    @classmethod
+    def from_api(
+        cls, channel: dict[str, Any], member: dict[str, Any] | None
+    ) -> "Channel":
+        """Create channel from channels_for_user and channel_members_for_user"""
+        return cls(
+            channel["id"],
+            channel.get("type"),
+            channel.get("team_id") or "",
+            channel.get("display_name"),
+            channel.get("name") or "",
+            member.get("mention_count") if member else None,
+            member.get("msg_count") if member else None,
+            channel.get("total_msg_count"),
+            channel.get("update_at"),
+            channel.get("last_post_at"),
+        )
+
+    @property
+    def msg_unread_count(self) -> int:
+        if self.total_msg_count is None or self.msg_count is None:
+            return 0
+
+        return self.total_msg_count - self.msg_count
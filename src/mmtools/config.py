@@ -8,22 +8,20 @@ from typing import cast
 import caep
 from pydantic import Field
 
-from mmtools import arguments
+from mmtools import CONFIG_ID, CONFIG_NAME, arguments
 
 
 class Config(arguments.Config):
     show: bool = Field(False, description="Print default config")
     init: bool = Field(
         False,
-        description=f"Copy default config to {caep.get_config_dir(arguments.CONFIG_ID)}/{arguments.CONFIG_NAME}",
+        description=f"Copy default config to {caep.get_config_dir(CONFIG_ID)}/{CONFIG_NAME}",
     )
 
 
 def default_ini() -> str:
     """Get content of default ini file"""
-    return (
-        resources.files("mmtools").joinpath(f"etc/{arguments.CONFIG_NAME}").read_text()
-    )
+    return resources.files("mmtools").joinpath(f"etc/{CONFIG_NAME}").read_text()
 
 
 def save_config(filename: Path) -> None:
@@ -49,8 +47,8 @@ def main() -> None:
     if args.show:
         print(default_ini())
     elif args.init:
-        config_dir = caep.get_config_dir(arguments.CONFIG_ID, create=True)
-        save_config(Path(config_dir) / arguments.CONFIG_NAME)
+        config_dir = caep.get_config_dir(CONFIG_ID, create=True)
+        save_config(Path(config_dir) / CONFIG_NAME)
 
     else:
         arguments.fatal("You must specify --show or --init")
@@ -0,0 +1,263 @@
+"""mmtools - connection handling
+
+REST requests share one keep-alive session (see mattermost.Client). Failed
+connections are retried with exponential backoff and jitter, and the session
+is only authenticated again when the server rejects the token (401).
+
+The requests of one status poll share a Deadline, so a poll never takes
+longer than the deadline, however many requests it needs.
+
+The websocket is reconnected in-process by Mattermost.init_websocket. The
+server is asked to replay events missed while disconnected (reliable
+websockets), with the connection id and sequence number kept in
+WebsocketSession.
+"""
+
+import asyncio
+import json
+import random
+import re
+import ssl
+import time
+from collections.abc import Awaitable, Callable
+from logging import debug, info
+from typing import Any
+
+import requests
+import websockets
+from mattermostdriver import exceptions as driver_exceptions  # type: ignore
+from mattermostdriver import websocket as driver_websocket
+
+# Hello event, sent by the server when the websocket is authenticated
+HELLO = re.compile(r'^\s*\{\s*"event"\s*:\s*"hello"')
+
+# Sequence number of events, the last key of events sent by the server
+SEQUENCE = re.compile(r'"seq"\s*:\s*(\d+)')
+
+
+class Backoff:
+    """Exponential backoff with jitter"""
+
+    def __init__(self, initial: float = 1.0, maximum: float = 60.0) -> None:
+        self.initial = initial
+        self.maximum = maximum
+        self.attempts = 0
+
+    def delay(self) -> float:
+        """Delay (seconds) before next attempt"""
+        delay = min(self.maximum, self.initial * 2.0 ** min(self.attempts, 32))
+        self.attempts += 1
+
+        # At least half of the delay, randomized so clients do not retry in lockstep
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def reset(self) -> None:
+        """Reset after a successful attempt"""
+        self.attempts = 0
+
+
+class PollInterval:
+    """
+    Adaptive time between polls: the shortest interval when the unread state
+    has changed, doubled for every poll without changes up to the longest
+    interval, and the longest interval while the screen is locked or idle
+    """
+
+    def __init__(self, initial: float, minimum: float, maximum: float) -> None:
+        self.minimum = min(minimum, initial)
+        self.maximum = max(maximum, initial)
+        self.current = initial
+
+    def next(self, changed: bool, idle: bool = False) -> float:
+        """Seconds until the next poll"""
+        if idle:
+            self.current = self.maximum
+        elif changed:
+            self.current = self.minimum
+        else:
+            self.current = min(self.maximum, self.current * 2)
+
+        return self.current
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """The time budget of the poll is used up"""
+
+
+class Deadline:
+    """Time budget shared by the requests of one poll"""
+
+    def __init__(self, seconds: float) -> None:
+        self.end = time.monotonic() + seconds if seconds else None
+
+    def remaining(self) -> float | None:
+        """Seconds left, None if there is no deadline"""
+        if self.end is None:
+            return None
+
+        return self.end - time.monotonic()
+
+    def timeout(self, timeout: float) -> float:
+        """
+        Timeout of the next request: the time left, if less than timeout.
+        Raises DeadlineExceeded if no time is left
+        """
+        remaining = self.remaining()
+
+        if remaining is None:
+            return timeout
+
+        if remaining <= 0:
+            raise DeadlineExceeded("Deadline exceeded")
+
+        return min(timeout, remaining)
+
+
+class WebsocketSession:
+    """Websocket state kept between connections"""
+
+    def __init__(self) -> None:
+        self.connection_id: str | None = None
+        self.sequence: int | None = None
+        self.connections = 0
+        self.resumed = False
+
+    def query(self) -> str:
+        """Query string to resume the previous connection"""
+        if not self.connection_id or self.sequence is None:
+            return ""
+
+        return (
+            f"?connection_id={self.connection_id}&sequence_number={self.sequence + 1}"
+        )
+
+    def received(self, event: str) -> bool:
+        """Keep track of connection and sequence number. Returns True on hello"""
+        if HELLO.match(event):
+            hello = json.loads(event)
+            connection_id = (hello.get("data") or {}).get("connection_id")
+            self.resumed = bool(connection_id) and connection_id == self.connection_id
+            self.connection_id = connection_id
+
+            if not self.resumed:
+                self.sequence = hello.get("seq")
+
+            info(
+                "websocket connected (connection %s, resumed=%s)",
+                connection_id,
+                self.resumed,
+            )
+            return True
+
+        # Check the end of the event first, where the server puts the sequence
+        match = SEQUENCE.search(event, max(0, len(event) - 32)) or SEQUENCE.search(
+            event
+        )
+
+        if match:
+            self.sequence = int(match.group(1))
+
+        return False
+
+
+class Websocket(driver_websocket.Websocket):  # type: ignore
+    """
+    Driver websocket for a single connection. Returns when disconnected, and
+    raises if the connection fails or is lost, so the caller can reconnect
+    with backoff (and a new token)
+    """
+
+    def __init__(
+        self, options: dict[str, Any], token: str, session: WebsocketSession
+    ) -> None:
+        super().__init__(options, token)
+        self.session = session
+
+    @property
+    def alive(self) -> bool:
+        """False if disconnect() has been called"""
+        return bool(self._alive)
+
+    async def connect(self, event_handler: Callable[[str], Awaitable[None]]) -> None:
+        """Connect, authenticate and handle events until disconnected"""
+        context: ssl.SSLContext | None = ssl.create_default_context(
+            purpose=ssl.Purpose.CLIENT_AUTH
+        )
+        if context and not self.options["verify"]:
+            context.verify_mode = ssl.CERT_NONE
+
+        scheme = "wss://"
+        if self.options["scheme"] != "https":
+            scheme = "ws://"
+            context = None
+
+        url = (
+            f"{scheme}{self.options['url']}:{self.options['port']}"
+            f"{self.options['basepath']}/websocket{self.session.query()}"
+        )
+
+        self._alive = True
+        self.session.connections += 1
+
+        debug("connecting websocket %s", url)
+
+        async with websockets.connect(
+            url, ssl=context, **(self.options["websocket_kw_args"] or {})
+        ) as websocket:
+            await self._authenticate_websocket(websocket, event_handler)
+            await self._start_loop(websocket, event_handler)
+
+    async def _start_loop(
+        self,
+        websocket: Any,
+        event_handler: Callable[[str], Awaitable[None]],
+    ) -> None:
+        """
+        Handle events until disconnected, and send a heartbeat if no event is
+        received within the timeout. Only waiting for an event is covered by
+        the timeout (unlike the driver), so a handler is never cancelled
+        while it handles an event
+        """
+        while self._alive:
+            try:
+                message = await asyncio.wait_for(
+                    websocket.recv(), timeout=self.options["timeout"]
+                )
+            except TimeoutError:
+                debug("sending heartbeat")
+                await websocket.pong()
+                continue
+
+            await event_handler(message)
+
+    async def _authenticate_websocket(
+        self,
+        websocket: Any,
+        event_handler: Callable[[str], Awaitable[None]],
+    ) -> None:
+        """Authenticate with token, raises NoAccessTokenProvided if rejected"""
+        await websocket.send(
+            json.dumps(
+                {
+                    "seq": 1,
+                    "action": "authentication_challenge",
+                    "data": {"token": self._token},
+                }
+            )
+        )
+
+        while True:
+            message = await websocket.recv()
+
+            # The hello event could arrive before the authentication response
+            await event_handler(message)
+
+            status = json.loads(message)
+
+            if status.get("event") == "hello":
+                return
+
+            if status.get("status") == "FAIL":
+                raise driver_exceptions.NoAccessTokenProvided(
+                    f"websocket authentication failed: {status.get('error')}"
+                )
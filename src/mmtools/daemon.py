@@ -0,0 +1,111 @@
+"""mmtools - unread state server/client over unix domain socket
+
+mmwatch keeps the unread state up to date from websocket events, and serves
+it on a unix socket. The status bar tools read the state from the socket, and
+only fall back to the REST API if mmwatch is not running.
+"""
+
+import dataclasses
+import json
+import os
+import socket
+from collections.abc import Callable
+from logging import debug, info, warning
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from mmtools import CONFIG_ID, cache
+from mmtools.channel import Channel
+
+if TYPE_CHECKING:
+    import asyncio
+
+
+def socket_path(server: str, port: int, user: str, path: str | None = None) -> Path:
+    """
+    Get path to state socket. Defaults to a socket per server/user
+    in $XDG_RUNTIME_DIR/mmtools, with fallback to the cache directory
+    """
+    if path:
+        return Path(path)
+
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+
+    if runtime_dir:
+        directory = Path(runtime_dir) / CONFIG_ID
+        directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+    else:
+        directory = cache.cache_dir()
+
+    return directory / f"{cache.digest(server, str(port), user)}.sock"
+
+
+async def start_server(
+    path: Path, state: Callable[[], list[Channel]]
+) -> "asyncio.AbstractServer | None":
+    """
+    Serve unread state on unix socket. Every client gets the current
+    state as one line of json, and the connection is closed
+    """
+    import asyncio
+
+    async def handle(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            writer.write(
+                json.dumps(
+                    {"channels": [dataclasses.asdict(channel) for channel in state()]}
+                ).encode()
+                + b"\n"
+            )
+            await writer.drain()
+        except ConnectionError as e:
+            debug("state client disconnected: %s", e)
+        finally:
+            writer.close()
+
+    if path.exists():
+        if query(path) is not None:
+            warning("mmwatch is already serving state on %s", path)
+            return None
+        # Stale socket from a process that did not exit cleanly
+        path.unlink()
+
+    server = await asyncio.start_unix_server(handle, path=str(path))
+    path.chmod(0o600)
+    info("serving state on %s", path)
+
+    return server
+
+
+def stop_server(server: "asyncio.AbstractServer | None", path: Path) -> None:
+    """Stop server and remove socket"""
+    if server:
+        server.close()
+        path.unlink(missing_ok=True)
+
+
+def query(path: Path, timeout: float = 0.5) -> list[Channel] | None:
+    """
+    Get unread channels from running mmwatch. Returns None if
+    mmwatch is not running (or does not respond)
+    """
+    data = b""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(path))
+            while chunk := sock.recv(65536):
+                data += chunk
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    except OSError as e:
+        warning("Unable to get state from %s: %s", path, e)
+        return None
+
+    try:
+        return [Channel(**channel) for channel in json.loads(data)["channels"]]
+    except (ValueError, KeyError, TypeError) as e:
+        warning("Invalid state from %s: %s", path, e)
+        return None
@@ -0,0 +1,36 @@
+"""mmtools - websocket events"""
+
+import json
+import re
+from typing import Any
+
+# The event type is the first field in events from the server
+EVENT_TYPE = re.compile(r'^\s*\{\s*"event"\s*:\s*"([^"\\]*)"')
+
+
+def parse_event_type(event: str) -> str | None:
+    """Get event type from websocket event without decoding all of it"""
+    match = EVENT_TYPE.match(event)
+
+    if match:
+        return match.group(1)
+
+    # Fallback if event is not first or not a string
+    event_type = json.loads(event).get("event")
+
+    return event_type if isinstance(event_type, str) else None
+
+
+def decode_event(event: str) -> dict[str, Any]:
+    """Decode websocket event, including fields in data that are json encoded"""
+    d: dict[str, Any] = json.loads(event)
+
+    for field, value in d.get("data", {}).items():
+        # Attempt to parse as json in data fields
+        if isinstance(value, str):
+            try:
+                d["data"][field] = json.loads(value)
+            except ValueError:
+                pass
+
+    return d
@@ -0,0 +1,289 @@
+"""mmtools - fast start of the status tools
+
+mmstatus and mmwaybar are started by the status bar on every interval (and
+mmjson by scripts). If mmwatch is running and the parsed config is cached
+(and still valid), the status is rendered from the mmwatch state without
+importing pydantic, caep, requests or the mattermost driver, and without
+running gpg. Otherwise the full status tool is run, which also updates the
+config cache.
+
+Only the standard library and the light mmtools modules (cache, channel,
+daemon, log, render and rules) may be imported here. These modules keep their
+own rarely used or slow imports inside the functions that need them.
+"""
+
+import os
+import socket
+import sys
+from collections.abc import Iterable
+from logging import debug
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, cast
+
+from mmtools import CONFIG_ID, CONFIG_NAME, cache, daemon, render, rules
+from mmtools.log import setup_logging
+
+if TYPE_CHECKING:
+    from mmtools import arguments
+
+# Config model of the status tools. Other tools (mmwatch, mmevents) read the
+# same section with other models, and are cached separately
+STATUS_MODEL = "mmtools.status.Config"
+
+# Fields used by the fast start path. A cached config without them is not used
+FIELDS = (
+    "server",
+    "port",
+    "user",
+    "socket",
+    "channel_rules",
+    "ignore",
+    "no_daemon",
+    "profile",
+    "profile_output",
+    "loglevel",
+    "logfile",
+    "chat_prefix",
+    "user_color",
+    "channel_color",
+    "mention_color",
+    "stream",
+)
+ACCOUNT_FIELDS = ("server", "port", "user", "socket", "channel_rules", "ignore")
+
+
+def config_names() -> list[str]:
+    """Config file names, in order of precedence (host specific config first)"""
+    hostname = socket.gethostname()
+    hostname_short = hostname.split(".")[0]
+
+    return [f"{CONFIG_NAME}-{hostname}", f"{CONFIG_NAME}-{hostname_short}", CONFIG_NAME]
+
+
+def config_sources() -> list[str]:
+    """All config files caep may read"""
+    config_dir = cache.xdg_dir("XDG_CONFIG_HOME", ".config")
+
+    return [
+        str(directory / name)
+        for name in config_names()
+        for directory in (config_dir, Path("/etc"))
+    ]
+
+
+def mtimes(filenames: Iterable[str]) -> dict[str, int | None]:
+    """Modification time of files, None if the file does not exist"""
+    result: dict[str, int | None] = {}
+    for filename in filenames:
+        try:
+            result[filename] = Path(filename).stat().st_mtime_ns
+        except OSError:
+            result[filename] = None
+    return result
+
+
+def env_digest(names: list[str]) -> str:
+    """Hash of environment variables (caep uses them as defaults)"""
+    return cache.digest(
+        *(
+            f"{name}={os.environ[name]}" if name in os.environ else name
+            for name in names
+        )
+    )
+
+
+def config_file(section: str, model: str) -> Path | None:
+    """
+    Get path to the config cache for section, config model (module and
+    class) and command line arguments. Returns None if config files are
+    specified with --config, since they are not tracked
+    """
+    argv = sys.argv[1:]
+
+    if any(arg.startswith("--config") for arg in argv):
+        return None
+
+    return cache.cache_file("config", section, model, *argv)
+
+
+def save_config(
+    section: str,
+    args: "arguments.Config",
+    accounts: dict[str, "arguments.Config"] | None = None,
+) -> None:
+    """
+    Cache parsed and validated config, and the config of additional accounts.
+    The password is not cached, since it is only needed to login, which is
+    left to the full status tool
+    """
+    model = type(args)
+    filename = config_file(section, f"{model.__module__}.{model.__qualname__}")
+
+    if not filename:
+        return
+
+    # Also invalidate the cache if the config model is changed (upgrade)
+    sources = config_sources() + [
+        str(sys.modules[cls.__module__].__file__)
+        for cls in type(args).__mro__
+        if cls.__module__.startswith(f"{CONFIG_ID}.")
+    ]
+    env = [name.upper() for name in type(args).model_fields]
+
+    cache.write_json(
+        filename,
+        {
+            "sources": mtimes(sources),
+            "env": env,
+            "env_digest": env_digest(env),
+            "args": args.model_dump(mode="json", exclude={"password"}),
+            "accounts": {
+                name: account.model_dump(mode="json", exclude={"password"})
+                for (name, account) in (accounts or {}).items()
+            },
+        },
+    )
+
+
+def load_config(
+    section: str, model: str = STATUS_MODEL
+) -> tuple[dict[str, Any], dict[str, dict[str, Any]]] | None:
+    """
+    Get cached config, and config of additional accounts. Returns None if not
+    cached, if any config file or environment variable has changed since it
+    was cached, or if fields used by the fast start path are missing
+    """
+    filename = config_file(section, model)
+
+    if not filename:
+        return None
+
+    data = cache.read_json(filename)
+
+    try:
+        if (
+            set(config_sources()) <= data["sources"].keys()
+            and mtimes(data["sources"]) == data["sources"]
+            and env_digest(data["env"]) == data["env_digest"]
+            and all(field in data["args"] for field in FIELDS)
+            and all(
+                field in account
+                for account in data["accounts"].values()
+                for field in ACCOUNT_FIELDS
+            )
+        ):
+            return (
+                cast(dict[str, Any], data["args"]),
+                cast(dict[str, dict[str, Any]], data["accounts"]),
+            )
+    except (TypeError, KeyError, AttributeError):
+        pass
+
+    return None
+
+
+def channel_filter(
+    channel_rules: str | None, ignore: str | None, server: str, port: int, user: str
+) -> rules.ChannelFilter:
+    """
+    Channel filter from config. Team names are read from the session cache,
+    only if any rule matches on team
+    """
+
+    def teams() -> list[dict[str, Any]] | None:
+        session = cache.read_json(cache.cache_file("session", server, str(port), user))
+        return session.get("teams") if isinstance(session, dict) else None
+
+    return rules.ChannelFilter(rules.parse(channel_rules, ignore), teams)
+
+
+def daemon_status(
+    section: str,
+) -> tuple[dict[str, Any], render.Summary] | None:
+    """
+    Get status from running mmwatch, with cached config. Returns None if the config
+    is not cached or mmwatch is not running (the full status tool must be used).
+
+    The status of additional accounts is merged, with channel names prefixed
+    with the account name
+    """
+    config = load_config(section)
+
+    if not config:
+        return None
+
+    (args, accounts) = config
+
+    # Profiling (--profile) is only done by the full status tool
+    if args["no_daemon"] or args["profile"] or args["profile_output"]:
+        return None
+
+    setup_logging(args["loglevel"], args["logfile"], stream=sys.stderr)
+
+    summary = render.Summary()
+
+    for prefix, account in [("", args)] + [
+        (f"{name}/", account) for (name, account) in accounts.items()
+    ]:
+        channels = daemon.query(
+            daemon.socket_path(
+                account["server"], account["port"], account["user"], account["socket"]
+            )
+        )
+
+        if channels is None:
+            return None
+
+        shown = channel_filter(
+            account["channel_rules"],
+            account["ignore"],
+            account["server"],
+            account["port"],
+            account["user"],
+        )
+        summary.merge(render.summarize(channels, shown, prefix))
+
+    debug("fast start, status from mmwatch")
+
+    return (args, summary)
+
+
+def run(name: str, streams: bool = True) -> None:
+    """
+    Output status in format name (see render.FORMATS) from mmwatch, and
+    otherwise run the full status tool
+    """
+    fast = daemon_status("mmstatus")
+
+    # Streaming keeps its own websocket
+    if fast is None or (streams and fast[0].get("stream")):
+        from mmtools import status
+
+        status.run(name, streams)
+        return
+
+    (args, summary) = fast
+
+    style = render.Style(
+        args["chat_prefix"],
+        args["user_color"],
+        args["channel_color"],
+        args["mention_color"],
+    )
+    print(render.FORMATS[name].status(summary, style, None))
+    render.flush_stdout()
+
+
+def i3blocks() -> None:
+    """Output channel status in i3blocks format"""
+    run("i3blocks", streams=False)
+
+
+def waybar() -> None:
+    """Output channel status in waybar format"""
+    run("waybar")
+
+
+def json_output() -> None:
+    """Output unread state as json"""
+    run("json")
@@ -0,0 +1,138 @@
+"""mmtools - event journal
+
+mmwatch appends the websocket events it handles (posts and channel views) to
+an append-only journal, one raw event per line, prefixed with the time it
+was received:
+
+    <unix time> <event>
+
+Writes are buffered and synced to disk (fsync) at most once every
+sync_interval seconds. When the journal grows beyond max_bytes, the channel
+state is saved (checkpoint) and the journal is rotated to <journal>.1, so
+the journal never uses more than about 2 * max_bytes.
+
+On startup, the events journaled after the channel cache was saved are
+replayed through the event handler, so the unread state of the previous
+run is served at once, before the channels are updated from the server.
+"""
+
+import os
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from logging import debug, warning
+from pathlib import Path
+from typing import TextIO
+
+from mmtools import cache
+
+
+def journal_file(server: str, port: int, user: str) -> Path:
+    """Journal file of account"""
+    return cache.cache_file("journal", server, str(port), user).with_suffix(".jsonl")
+
+
+class Journal:
+    """Append-only, size bounded journal of websocket events"""
+
+    def __init__(self, path: Path, max_bytes: int, sync_interval: float) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.sync_interval = sync_interval
+        self.unsynced = False
+
+        self.file = self.open()
+        self.size = self.file.tell()
+
+    def open(self) -> TextIO:
+        """Open journal for appending, readable by the user only (like the cache)"""
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        return os.fdopen(fd, "a", encoding="utf-8")
+
+    @property
+    def full(self) -> bool:
+        """True if the journal should be rotated"""
+        return self.size >= self.max_bytes
+
+    def append(self, event: str) -> None:
+        """Append event (buffered until the next sync)"""
+        # Events are json, but could be pretty printed
+        line = f"{time.time():.6f} {event.replace(chr(10), ' ')}\n"
+        self.file.write(line)
+        self.size += len(line)
+        self.unsynced = True
+
+    def sync(self) -> None:
+        """Write buffered events to disk"""
+        if not self.unsynced:
+            return
+
+        self.unsynced = False
+
+        try:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except OSError as e:
+            warning("Unable to write journal %s: %s", self.path, e)
+
+    def rotate(self) -> None:
+        """Start a new journal, the current journal is kept as <journal>.1"""
+        self.sync()
+        self.file.close()
+
+        debug("rotating journal %s (%s bytes)", self.path, self.size)
+
+        try:
+            self.path.replace(rotated(self.path))
+        except OSError as e:
+            warning("Unable to rotate journal %s: %s", self.path, e)
+            self.path.unlink(missing_ok=True)
+
+        self.file = self.open()
+        self.size = 0
+
+    def close(self) -> None:
+        """Sync and close journal"""
+        self.sync()
+        self.file.close()
+
+
+def rotated(path: Path) -> Path:
+    """Rotated journal of path"""
+    return path.with_name(f"{path.name}.1")
+
+
+def read(path: Path, since: float = 0) -> Iterator[str]:
+    """
+    Events journaled after since (unix time), oldest first, from the rotated
+    and the current journal. Malformed lines (e.g. the last line, if mmwatch
+    was killed while writing it) are skipped
+    """
+    for filename in (rotated(path), path):
+        try:
+            with filename.open(encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    (timestamp, _, event) = line.partition(" ")
+
+                    try:
+                        if float(timestamp) <= since:
+                            continue
+                    except ValueError:
+                        continue
+
+                    if event.endswith("\n"):
+                        yield event[:-1]
+        except FileNotFoundError:
+            continue
+
+
+async def replay(
+    events: Iterator[str], event_handler: Callable[[str], Awaitable[None]]
+) -> int:
+    """Run events through event_handler as fast as possible, returns count"""
+    count = 0
+
+    for event in events:
+        await event_handler(event)
+        count += 1
+
+    return count
@@ -0,0 +1,63 @@
+"""mmtools - incremental parsing of json arrays
+
+Large responses (channels and channel members of users in thousands of
+channels) are parsed while they are downloaded, so neither the full response
+body nor the full list of decoded items is kept in memory.
+"""
+
+import codecs
+import json
+from collections.abc import Iterable, Iterator
+from typing import Any
+
+# Separators between objects in an array, compact (Mattermost) and python default
+SEPARATORS = ("},{", "}, {")
+
+
+def iter_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+    """
+    Items of a json array, decoded from chunks (utf-8) of the array.
+
+    The complete objects in the buffer, up to the last separator between two
+    objects, are decoded with one call to json.loads. If the separator is
+    not between two items (but in a string or a nested array), decoding fails
+    and is tried again when more data is read.
+    """
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = False
+
+    for chunk in chunks:
+        buffer += text.decode(chunk)
+
+        if not started:
+            buffer = buffer.lstrip()
+
+            if not buffer:
+                continue
+
+            if buffer[0] != "[":
+                raise ValueError(f"Expected json array, got {buffer[:20]!r}")
+
+            buffer = buffer[1:]
+            started = True
+
+        end = max(buffer.rfind(separator) for separator in SEPARATORS)
+
+        if end < 0:
+            continue
+
+        try:
+            items = json.loads(f"[{buffer[: end + 1]}]")
+        except json.JSONDecodeError:
+            continue
+
+        buffer = buffer[end + 1 :].lstrip(", \t\n\r")
+        yield from items
+
+    rest = (buffer + text.decode(b"", final=True)).strip()
+
+    if not started or not rest.endswith("]"):
+        raise ValueError("Incomplete json array")
+
+    yield from json.loads(f"[{rest}")
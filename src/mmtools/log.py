@@ -0,0 +1,48 @@
+"""mmtools - logging"""
+
+import logging
+import sys
+from pathlib import Path
+from typing import TextIO
+
+
+def setup_logging(
+    loglevel: str = "debug",
+    logfile: str | None = None,
+    prefix: str = "mmtools",
+    maxBytes: int = 10000000,  # 10 MB
+    backupCount: int = 5,
+    stream: TextIO = sys.stdout,
+) -> None:
+    """
+    Setup loglevel and optional log to file. Without a log file, logs are
+    written to stream (the status bar tools log to stderr, since the bar
+    reads the status from stdout)
+    """
+    numeric_level = getattr(logging, loglevel.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError(f"Invalid log level: {loglevel}")
+
+    datefmt = "%Y-%m-%d %H:%M:%S"
+    formatter = "[%(asctime)s] app=" + prefix + " level=%(levelname)s msg=%(message)s"
+
+    if logfile:
+        from logging.handlers import RotatingFileHandler
+
+        logdir = Path(logfile).parent
+
+        if not logdir.is_dir():
+            logdir.mkdir(parents=True)
+
+        # Support strftime in log file names
+        handlers = [
+            RotatingFileHandler(logfile, maxBytes=maxBytes, backupCount=backupCount)
+        ]
+
+        logging.basicConfig(
+            level=numeric_level, handlers=handlers, format=formatter, datefmt=datefmt
+        )
+    else:
+        logging.basicConfig(
+            level=numeric_level, stream=stream, format=formatter, datefmt=datefmt
+        )
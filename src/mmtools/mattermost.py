@@ -1,77 +1,531 @@
 """Mattermost module"""
 
-import functools
-from collections.abc import Callable
-from logging import debug
-from typing import cast
-
+import asyncio
+import json
+import time
+from collections.abc import Awaitable, Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from logging import debug, exception, info, warning
+from pathlib import Path
+from typing import Any, cast
+
+import requests
+import websockets
 from mattermostdriver import Driver  # type: ignore
-from pydantic import BaseModel, SecretStr
+from mattermostdriver import client as driver_client
+from mattermostdriver import exceptions as driver_exceptions
+from mattermostdriver.exceptions import NoAccessTokenProvided  # type: ignore
+from pydantic import BaseModel, ValidationError
+
+from mmtools import arguments, cache, connection, jsonstream, metrics, profiling
+from mmtools.channel import Channel, direct_user
+
+# Max concurrent requests, shared by all accounts in the process, and
+# max connections per server
+POOL_SIZE = 10
+
+# Bytes read at a time from streamed responses
+CHUNK_SIZE = 64 * 1024
+
+# Worker threads for requests, shared by all accounts (see --accounts).
+# Threads are only started when needed
+EXECUTOR = ThreadPoolExecutor(POOL_SIZE, thread_name_prefix="mmtools")
+
+DRIVER_EXCEPTIONS = {
+    400: driver_exceptions.InvalidOrMissingParameters,
+    401: driver_exceptions.NoAccessTokenProvided,
+    403: driver_exceptions.NotEnoughPermissions,
+    404: driver_exceptions.ResourceNotFound,
+    405: driver_exceptions.MethodNotAllowed,
+    413: driver_exceptions.ContentTooLarge,
+    501: driver_exceptions.FeatureDisabled,
+}
+
+
+def record_response(response: requests.Response, *args: Any, **kwargs: Any) -> None:
+    """Session hook, record request metrics"""
+    endpoint = metrics.endpoint(response.request.path_url)
+    metrics.inc(
+        "mmtools_rest_requests_total",
+        endpoint=endpoint,
+        status=str(response.status_code),
+    )
+    metrics.observe(
+        "mmtools_rest_request_seconds",
+        response.elapsed.total_seconds(),
+        endpoint=endpoint,
+    )
+
+
+def profile_name(response: requests.Response) -> str:
+    """Method and endpoint of request, as shown in the profile"""
+    return f"{response.request.method} {metrics.endpoint(response.request.path_url)}"
+
+
+def profile_response(response: requests.Response, *args: Any, **kwargs: Any) -> None:
+    """
+    Session hook, add request (and bytes transferred) to profile. Streamed
+    responses are added by profile_streamed when their body is read
+    """
+    if kwargs.get("stream"):
+        return
+
+    body = response.request.body or b""
+    # Compressed size if available
+    size = response.headers.get("Content-Length")
+    profiling.request(
+        profile_name(response),
+        response.elapsed.total_seconds(),
+        (int(size) if size else len(response.content)) + len(body),
+    )
+
+
+def profile_streamed(response: requests.Response, start: float) -> None:
+    """
+    Add streamed request (started at start, perf_counter) to profile, with
+    the bytes read from the connection so far (compressed)
+    """
+    body = response.request.body or b""
+    profiling.request(
+        profile_name(response),
+        time.perf_counter() - start,
+        response.raw.tell() + len(body),
+    )
+
+
+class Client(driver_client.Client):  # type: ignore
+    """
+    Mattermost driver client, using a pooled keep-alive session (the driver
+    opens a new connection per request) and with support for conditional requests
+    """
+
+    def __init__(self, options: dict[str, Any]) -> None:
+        super().__init__(options)
+        # Deadline of the current poll, see Mattermost.deadline
+        self.deadline: connection.Deadline | None = None
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        if metrics.ENABLED:
+            self.session.hooks["response"].append(record_response)
+
+        if profiling.PROFILER:
+            self.session.hooks["response"].append(profile_response)
+
+    def timeout(self) -> float:
+        """Request timeout, limited by the deadline of the current poll"""
+        if self.deadline is None:
+            return float(self.request_timeout)
+
+        return self.deadline.timeout(self.request_timeout)
+
+    def check_response(self, response: requests.Response) -> None:
+        """Raise driver exceptions on errors, as the driver client does"""
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            try:
+                message = response.json().get("message", response.text)
+            except (ValueError, AttributeError):
+                message = response.text
+
+            exception = DRIVER_EXCEPTIONS.get(response.status_code)
+
+            if exception:
+                raise exception(message) from None
+            raise
+
+    def make_request(  # type: ignore
+        self,
+        method,
+        endpoint,
+        options=None,
+        params=None,
+        data=None,
+        files=None,
+        basepath=None,
+    ):
+        """Same as the driver client, but using the session"""
+        if basepath:
+            url = f"{self._scheme}://{self._options['url']}:{self._port}{basepath}"
+        else:
+            url = self.url
+
+        request_params = {
+            "headers": self.auth_header(),
+            "verify": self._verify,
+            "json": options or {},
+            "params": params or {},
+            "data": data or {},
+            "files": files,
+            "timeout": self.timeout(),
+        }
 
-from mmtools import arguments
+        if self._auth is not None:
+            request_params["auth"] = self._auth()
 
+        response = self.session.request(
+            method.upper(), url + endpoint, **request_params
+        )
+        self.check_response(response)
 
-class Channel(BaseModel):
-    """Mattermost channel model"""
+        return response
 
-    id: str | None
-    type: str | None
-    header: str | None
-    purpose: str | None
-    display_name: str | None
-    name: str = ""
-    mention_count: int | None
-    msg_count: int | None
-    update_at: int | None
-    last_post_at: int | None
-    total_msg_count: int | None
-    dirty: bool | None = None
+    def get_if_none_match(
+        self, endpoint: str, etag: str | None
+    ) -> tuple[Any, str | None]:
+        """
+        GET endpoint with If-None-Match. Returns (None, etag) if the server
+        responds with 304 Not Modified, otherwise (json, new etag)
+        """
+        headers = self.auth_header() or {}
+        if etag:
+            headers["If-None-Match"] = etag
+
+        response = self.session.get(
+            self.url + endpoint,
+            headers=headers,
+            verify=self._verify,
+            timeout=self.timeout(),
+        )
 
-    @property
-    def msg_unread_count(self) -> int:
-        if self.total_msg_count is None or self.msg_count is None:
-            return 0
+        if response.status_code == 304:
+            debug("not modified: %s", endpoint)
+            return (None, etag)
+
+        self.check_response(response)
+
+        return (response.json(), response.headers.get("ETag"))
 
-        return self.total_msg_count - self.msg_count
+    def iter_if_none_match(
+        self, endpoint: str, etag: str | None = None
+    ) -> tuple[Iterator[Any] | None, str | None]:
+        """
+        Same as get_if_none_match, for endpoints that return a json array.
+        The response is streamed (compressed, if supported by the server) and
+        items are decoded one by one as they are iterated
+        """
+        headers = self.auth_header() or {}
+        if etag:
+            headers["If-None-Match"] = etag
+
+        start = time.perf_counter()
+        response = self.session.get(
+            self.url + endpoint,
+            headers=headers,
+            verify=self._verify,
+            timeout=self.timeout(),
+            stream=True,
+        )
+
+        if response.status_code == 304:
+            debug("not modified: %s", endpoint)
+            response.close()
+            profile_streamed(response, start)
+            return (None, etag)
+
+        try:
+            self.check_response(response)
+        except Exception:
+            response.close()
+            profile_streamed(response, start)
+            raise
+
+        def chunks() -> Iterator[bytes]:
+            # The timeout only applies to each read, so check the deadline
+            # between chunks of large responses
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if self.deadline:
+                    self.deadline.timeout(self.request_timeout)
+                yield chunk
+
+        def items() -> Iterator[Any]:
+            # Release the connection, also if not fully iterated
+            try:
+                with response:
+                    yield from jsonstream.iter_array(chunks())
+            finally:
+                profile_streamed(response, start)
+
+        return (items(), response.headers.get("ETag"))
 
 
 class Mattermost:
     """Mattermost helper class"""
 
-    def __init__(self, args: arguments.Config) -> None:
+    def __init__(
+        self, args: arguments.Config, deadline: connection.Deadline | None = None
+    ) -> None:
         self.api = Driver(
             {
                 "url": args.server,
                 "login_id": args.user,
-                "password": cast(SecretStr, args.password).get_secret_value(),
-                "scheme": "https",
+                # Set on login, see login()
+                "password": None,
+                "scheme": args.scheme,
                 "port": args.port,
                 "basepath": "/api/v4",
                 "verify": not args.no_verify,
                 "timeout": 30,
                 "request_timeout": 30,
-            }
+            },
+            client_cls=Client,
+        )
+        self.deadline = deadline
+
+        self.args = args
+        self.username = args.user
+        self.session_ttl = args.session_ttl
+        self.session_file = (
+            None
+            if args.no_session_cache
+            else cache.cache_file("session", args.server, str(args.port), args.user)
         )
 
-        debug("login()")
-        self.api.login()
-        debug("get_user_by_username(%s)", args.user)
-        self.user = User(**self.api.users.get_user_by_username(args.user))
+        self.team = args.team
+        self.full_resync = args.full_resync
+        self.executor = EXECUTOR
+        self.channel_cache = not args.no_channel_cache
+        self.cache_keys = (args.server, str(args.port), args.user)
+        self.user_cache_ttl = args.user_cache_ttl
+        self.unknown_user_ttl = args.unknown_user_ttl
+        self.user_file = cache.cache_file("users", args.server, str(args.port))
+        # Unknown user ids (not returned by the server) have username None
+        self.usernames: dict[str, tuple[str | None, float]] = {}
+        self.backoff_initial = args.backoff_initial
+        self.backoff_max = args.backoff_max
+
+        # Posts after this time (ms) are replayed after a websocket reconnect
+        self.replay_since: int | None = None
+
         debug("Channels()")
         self.channels = Channels()
-        debug("get_user_teams(%s", self.user.id)
-        self.teams = self.api.teams.get_user_teams(self.user.id)
 
-    @functools.lru_cache(128)
+        with profiling.phase("resume session"):
+            resumed = self.resume_session()
+
+        if not resumed:
+            self.login()
+
+    @property
+    def deadline(self) -> connection.Deadline | None:
+        """Deadline of the current poll, shared by all its requests"""
+        return cast(connection.Deadline | None, self.api.client.deadline)
+
+    @deadline.setter
+    def deadline(self, deadline: connection.Deadline | None) -> None:
+        self.api.client.deadline = deadline
+
+    def resume_session(self) -> bool:
+        """
+        Resume session from session cache. The cached token is verified
+        with a single request, and a full login is only needed if the token
+        is expired or rejected by the server
+        """
+        if not self.session_file:
+            return False
+
+        with profiling.phase("read session cache"):
+            data = cache.read_json(self.session_file, max_age=self.session_ttl)
+
+        if not data:
+            return False
+
+        try:
+            session = Session(**data)
+        except ValidationError:
+            return False
+
+        self.api.client.token = session.token
+
+        try:
+            debug("get_user(me)")
+            me = self.api.users.get_user("me")
+        except NoAccessTokenProvided:
+            info("cached session is no longer valid")
+            self.api.client.token = ""
+            cache.remove(self.session_file)
+            return False
+
+        if me.get("id") != session.user.id:
+            self.api.client.token = ""
+            return False
+
+        self.api.client.userid = session.user.id
+        self.api.client.username = session.user.username
+        self.user = User(**me)
+        self.teams = session.teams
+
+        return True
+
+    def login(self) -> None:
+        """Full login, and save session to session cache"""
+        debug("login()")
+        metrics.inc("mmtools_logins_total")
+
+        with profiling.phase("login"):
+            with profiling.phase("get password"):
+                self.api.options["password"] = arguments.get_password(self.args)
+
+            self.api.login()
+            debug("get_user_by_username(%s)", self.username)
+            self.user = User(**self.api.users.get_user_by_username(self.username))
+            debug("get_user_teams(%s", self.user.id)
+            self.teams = self.api.teams.get_user_teams(self.user.id)
+
+            if self.session_file:
+                cache.write_json(
+                    self.session_file,
+                    Session(
+                        token=self.api.client.token, user=self.user, teams=self.teams
+                    ).model_dump(),
+                )
+
+    def load_usernames(self) -> None:
+        """
+        Load user id -> username cache shared by all mmtools. Malformed
+        entries are skipped
+        """
+        data = cache.read_json(self.user_file)
+
+        if not isinstance(data, dict):
+            return
+
+        now = time.time()
+        for user_id, entry in data.items():
+            if user_id in self.usernames or not isinstance(entry, list):
+                continue
+
+            if len(entry) != 2 or not isinstance(entry[1], (int, float)):
+                continue
+
+            (username, timestamp) = entry
+
+            if isinstance(username, str):
+                ttl = self.user_cache_ttl
+            elif username is None:
+                ttl = self.unknown_user_ttl
+            else:
+                continue
+
+            if timestamp > now - ttl:
+                self.usernames[user_id] = (username, timestamp)
+
+    def cached_user(self, user_id: str, now: float) -> bool:
+        """True if user_id is cached, unknown user ids expire after unknown_user_ttl"""
+        if user_id not in self.usernames:
+            return False
+
+        (username, timestamp) = self.usernames[user_id]
+        return username is not None or timestamp > now - self.unknown_user_ttl
+
+    def resolve_users(self, user_ids: Iterable[str]) -> None:
+        """
+        Resolve usernames of all unknown user ids with a single request. User
+        ids not returned by the server are cached as unknown, and are not
+        requested again for unknown_user_ttl seconds
+        """
+        if not self.usernames:
+            self.load_usernames()
+
+        requested = set(user_ids)
+        now = time.time()
+        unknown = {
+            user_id for user_id in requested if not self.cached_user(user_id, now)
+        }
+
+        metrics.inc("mmtools_user_cache_hits_total", len(requested) - len(unknown))
+
+        if not unknown:
+            return
+
+        metrics.inc("mmtools_user_cache_misses_total", len(unknown))
+
+        debug("get_users_by_ids(%s)", unknown)
+        with profiling.phase("resolve users"):
+            users = self.api.users.get_users_by_ids(sorted(unknown))
+            now = time.time()
+
+            for user_id in unknown:
+                self.usernames[user_id] = (None, now)
+
+            for user in users:
+                self.usernames[user["id"]] = (user["username"], now)
+
+            # Merge with usernames cached by other processes after we loaded the cache
+            self.load_usernames()
+            cache.write_json(self.user_file, self.usernames)
+
     def get_user(self, user_id: str) -> str:
         """Get username from user_id"""
-        debug("get_user(%s)", user_id)
-        user = self.api.users.get_user(user_id)
+        self.resolve_users([user_id])
 
-        if user:
-            return cast(str, user["username"])
+        if user_id in self.usernames:
+            return self.usernames[user_id][0] or "Unknown"
         return "Unknown"
 
+    def team_ids(self) -> list[str]:
+        """Team ids to get channels for, all teams unless a team is configured"""
+        if not self.team:
+            return [team["id"] for team in self.teams]
+
+        team_ids = [
+            team["id"]
+            for team in self.teams
+            if self.team in (team["id"], team["name"], team["display_name"])
+        ]
+
+        if not team_ids:
+            raise arguments.NotFound(f"Team not found: {self.team}")
+
+        return team_ids
+
+    def channel_file(self) -> Path | None:
+        """Channel cache file, None if the channel cache is disabled"""
+        if not self.channel_cache:
+            return None
+
+        return cache.cache_file("channels", *self.cache_keys)
+
+    def load_channel_cache(self) -> float | None:
+        """
+        Continue from the channel state of the previous run. Returns the time
+        the state was saved, or None if it is not loaded
+        """
+        channel_file = self.channel_file()
+
+        if not channel_file or self.channels.state:
+            return None
+
+        try:
+            saved = channel_file.stat().st_mtime
+        except OSError:
+            return None
+
+        with profiling.phase("read channel cache"):
+            data = cache.read_json(channel_file)
+
+        if not data or data.get("team_ids") != self.team_ids():
+            return None
+
+        try:
+            with profiling.phase("parse channel cache"):
+                self.channels = Channels(**data)
+        except ValidationError:
+            return None
+
+        return saved
+
+    def save_channel_cache(self) -> None:
+        """Save channel state, used by the next run"""
+        channel_file = self.channel_file()
+
+        if channel_file:
+            with profiling.phase("write channel cache"):
+                cache.write_json(channel_file, self.channels.model_dump())
+
     # Channels is not defined yet, and Channels depends on Mattermost in typing
     # so we need to quote the return definition
     # https://mypy.readthedocs.io/en/latest/kinds_of_types.html#class-name-forward-references
@@ -80,58 +534,411 @@ class Mattermost:
 
         debug("channels()")
 
-        self.channels.update(self, self.user.id, self.teams[0]["id"])
+        team_ids = self.team_ids()
+
+        # One-shot tools: continue from the state of the previous invocation
+        self.load_channel_cache()
+
+        try:
+            with profiling.phase("update channels"):
+                self.channels.update(self, self.user.id, team_ids, self.full_resync)
+        except NoAccessTokenProvided:
+            # Session expired/revoked after we resumed it
+            self.login()
+            with profiling.phase("update channels"):
+                self.channels.update(self, self.user.id, team_ids, self.full_resync)
+
+        self.save_channel_cache()
 
         return self.channels
 
-    def init_websocket(self, func: Callable) -> None:  # type: ignore
-        """Initialize websocket"""
+    def init_websocket(self, func: Callable[[str], Awaitable[None]]) -> None:
+        """Connect websocket and pass events to func until disconnected"""
+        asyncio.get_event_loop().run_until_complete(self.watch_websocket(func))
+
+    async def watch_websocket(self, func: Callable[[str], Awaitable[None]]) -> None:
+        """
+        Connect websocket and pass events to func until disconnected.
+
+        A lost connection is reconnected with exponential backoff. If the
+        server can not resume the connection (and replay the events we missed),
+        channels are updated from the REST API and posts we missed are replayed
+        to func as `posted` events, with "replayed" set.
+
+        The token is only renewed (login) if the server rejects it. Exceptions
+        raised by func are logged, and the event is skipped.
+
+        Websockets of several accounts can be watched concurrently on the
+        same event loop.
+        """
+        loop = asyncio.get_running_loop()
+        session = connection.WebsocketSession()
+        backoff = connection.Backoff(self.backoff_initial, self.backoff_max)
+
+        async def handle_event(event: str) -> None:
+            # A bad event (or a bug in func) must not stop the websocket loop
+            try:
+                await func(event)
+            except Exception:
+                exception("event handler failed: %.200s", event)
+
+        async def handler(event: str) -> None:
+            if session.received(event):
+                backoff.reset()
+
+                if session.connections > 1 and not session.resumed:
+                    await self.replay_missed(handle_event)
+
+            await handle_event(event)
+
+        while True:
+            websocket = connection.Websocket(
+                self.api.options, self.api.client.token, session
+            )
+            # Driver.disconnect() disconnects the current websocket
+            self.api.websocket = websocket
+
+            try:
+                await websocket.connect(handler)
+            except NoAccessTokenProvided as e:
+                info("%s, renewing session", e)
+                try:
+                    await loop.run_in_executor(self.executor, self.login)
+                except (OSError, requests.exceptions.RequestException) as e:
+                    warning("login failed: %s", e)
+            except (
+                TimeoutError,
+                OSError,
+                websockets.exceptions.WebSocketException,
+                requests.exceptions.RequestException,
+            ) as e:
+                warning("websocket connection lost: %s", e)
+
+            if not websocket.alive:
+                return
+
+            delay = backoff.delay()
+            info("reconnecting websocket in %.1f seconds", delay)
+            metrics.inc("mmtools_websocket_reconnects_total")
+
+            # Keep serving the event loop (e.g. daemon clients) while waiting
+            await asyncio.sleep(delay)
+
+    async def replay_missed(self, func: Callable[[str], Awaitable[None]]) -> None:
+        """Update channels, and replay posts missed while disconnected to func"""
+        loop = asyncio.get_running_loop()
+
+        if self.replay_since is None:
+            self.replay_since = max(
+                (channel.last_post_at or 0 for channel in self.channels.state.values()),
+                default=0,
+            )
+
+        info("replaying posts since %s", self.replay_since)
+
+        # Run in the default executor, since both submit requests to the
+        # (shared) request executor and wait for them
+        await loop.run_in_executor(None, self.init_channels)
+
+        if self.replay_since:
+            for event in await loop.run_in_executor(
+                None, self.missed_posts, self.replay_since
+            ):
+                await func(event)
+
+        self.replay_since = None
+
+    def missed_posts(self, since: int) -> list[str]:
+        """
+        Posts created after since (ms), as websocket `posted` events.
+
+        Only channels with posts after since (from the channel list) are
+        requested, concurrently.
+        """
+        pending = {
+            channel.id: self.executor.submit(
+                self.api.posts.get_posts_for_channel, channel.id, {"since": since}
+            )
+            for channel in self.channels.state.values()
+            if (channel.last_post_at or 0) > since
+        }
+
+        posts = sorted(
+            (
+                post
+                for request in pending.values()
+                for post in (request.result().get("posts") or {}).values()
+                if post.get("create_at", 0) > since and not post.get("delete_at")
+            ),
+            key=lambda post: post["create_at"],
+        )
+
+        self.resolve_users({post["user_id"] for post in posts})
+
+        events = []
+        for post in posts:
+            channel = self.channels.state[post["channel_id"]]
+            events.append(
+                json.dumps(
+                    {
+                        "event": "posted",
+                        "data": {
+                            "channel_display_name": channel.display_name or "",
+                            "channel_name": channel.name,
+                            "channel_type": channel.type,
+                            "post": json.dumps(post),
+                            "sender_name": f"@{self.get_user(post['user_id'])}",
+                            "team_id": channel.team_id,
+                            "mentions": json.dumps([self.user.id])
+                            if f"@{self.user.username}" in post.get("message", "")
+                            else None,
+                        },
+                        "broadcast": {"channel_id": channel.id},
+                        "replayed": True,
+                    }
+                )
+            )
+
+        info("replaying %s missed posts", len(events))
+        metrics.inc("mmtools_replayed_posts_total", len(events))
 
-        self.api.init_websocket(func)
+        return events
 
 
 class Channels(BaseModel):
-    """Channels model Keeps a list of channels"""
+    """
+    Channels model Keeps a list of channels with unread messages
 
-    channels: list[Channel] = []
+    All channels the user is member of is kept in `state`, so that we can
+    use conditional requests (ETag) to only fetch the channel list when
+    a channel is changed or has new posts (update_at/last_post_at)
+    """
 
-    def update(self, mm: Mattermost, user_id: str, team_id: str) -> None:
+    channels: list[Channel] = []
+    state: dict[str, Channel] = {}
+    team_ids: list[str] = []
+    etags: dict[str, str | None] = {}
+    updates: int = 0
+
+    def update(
+        self,
+        mm: Mattermost,
+        user_id: str,
+        team_ids: list[str],
+        full_resync: int = 0,
+    ) -> None:
         """
-        Get list of channels for user. We have to subtract msg_count
+        Get list of channels for user in all teams. We have to subtract msg_count
         from total_msg_count to get unread message count
 
         https://mattermost.uservoice.com/forums/306457-general/suggestions/38632564-api-add-new-msg-count-to-users-me-teams-team-i
+
+        Channel members (msg_count) changes when channels are viewed, so they are
+        always fetched. The channel list (total_msg_count) is only fetched if
+        modified since last update, with a full resync every `full_resync` update.
+
+        Requests for all teams are done concurrently.
         """
-        channel_members = {
-            channel["channel_id"]: channel
-            for channel in mm.api.channels.get_channel_members_for_user(
-                user_id, team_id
+        start = time.perf_counter()
+        full = (
+            team_ids != self.team_ids
+            or not self.etags
+            or bool(full_resync and self.updates % full_resync == 0)
+        )
+
+        member_requests = [
+            mm.executor.submit(self.channel_members, mm, user_id, team_id)
+            for team_id in team_ids
+        ]
+        channel_requests = {
+            team_id: mm.executor.submit(
+                self.team_channels,
+                mm,
+                f"/users/{user_id}/teams/{team_id}/channels",
+                None if full else self.etags.get(team_id),
+                full,
             )
+            for team_id in team_ids
         }
 
-        self.channels = []
-        for channel in mm.api.channels.get_channels_for_user(user_id, team_id):
-            # Merge results from channel_members_for_user and channels_for_user
-            channel.update(channel_members[channel["id"]])
-            channel = Channel(**channel)
+        with profiling.phase("channel requests"):
+            # Direct/group messages are listed in all teams
+            channel_members = {
+                channel_id: member
+                for request in member_requests
+                for (channel_id, member) in request.result().items()
+            }
+
+            modified = {}
+            for team_id, request in channel_requests.items():
+                (channels, self.etags[team_id]) = request.result()
 
-            if not channel.msg_unread_count:
-                continue
+                if channels is not None:
+                    modified[team_id] = channels
+
+        self.team_ids = team_ids
+        self.updates += 1
+
+        with profiling.phase("merge channels"):
+            if modified:
+                debug(
+                    "channel list modified in teams %s (full=%s)", list(modified), full
+                )
+
+                # Keep channels from teams that are not modified
+                state = {
+                    channel_id: channel
+                    for channel_id, channel in self.state.items()
+                    if channel.team_id in team_ids and channel.team_id not in modified
+                }
 
-            if not channel.display_name and "__" in channel.name:
-                # for 1-1 chats, the channel name is "<user_id>__<user_id>" where
-                # one of the user1 is yours (probably depends on who opened the
-                # private chat we need to check which user id is yours, and then
-                # lookup the username of the other user
+                for channels in modified.values():
+                    for channel in channels:
+                        state[channel.id] = channel
+                self.state = state
 
-                user1, user2 = channel.name.split("__")
+            for channel_id, channel in self.state.items():
+                member = channel_members.get(channel_id)
 
-                if user2 == user_id:
-                    channel.display_name = mm.get_user(user1)
+                if member:
+                    (channel.msg_count, channel.mention_count) = member
                 else:
-                    channel.display_name = mm.get_user(user2)
+                    # No longer member of channel
+                    channel.msg_count = channel.total_msg_count
+
+        self.refresh(mm, user_id)
+
+        metrics.inc("mmtools_channel_updates_total", full=str(full).lower())
+        metrics.observe("mmtools_channel_update_seconds", time.perf_counter() - start)
+
+    @staticmethod
+    def channel_members(
+        mm: Mattermost, user_id: str, team_id: str
+    ) -> dict[str, tuple[int, int]]:
+        """(msg_count, mention_count) per channel, decoded item by item"""
+        (members, _) = mm.api.client.iter_if_none_match(
+            f"/users/{user_id}/teams/{team_id}/channels/members"
+        )
 
+        return {
+            member["channel_id"]: (member["msg_count"], member["mention_count"])
+            for member in members or ()
+        }
+
+    def team_channels(
+        self, mm: Mattermost, endpoint: str, etag: str | None, full: bool
+    ) -> tuple[list[Channel] | None, str | None]:
+        """
+        Channels of team (None if not modified since etag). Channels are
+        created item by item as the response is decoded, and channels that are
+        unchanged since last update are kept (with the display name of 1-1 chats)
+        """
+        (items, etag) = mm.api.client.iter_if_none_match(endpoint, etag)
+
+        if items is None:
+            return (None, etag)
+
+        channels = []
+        for channel in items:
+            existing = self.state.get(channel["id"])
+
+            if (
+                existing
+                and not full
+                and existing.update_at == channel["update_at"]
+                and existing.last_post_at == channel["last_post_at"]
+            ):
+                channels.append(existing)
+            else:
+                # Unread counts are set from channel members in update()
+                channels.append(Channel.from_api(channel, None))
+
+        return (channels, etag)
+
+    def refresh(self, mm: Mattermost, user_id: str) -> None:
+        """Update list of channels with unread messages from state"""
+        self.channels = [
+            channel for channel in self.state.values() if channel.msg_unread_count
+        ]
+
+        self.resolve_names(mm, user_id, self.channels)
+
+    def resolve_names(
+        self, mm: Mattermost, user_id: str, channels: list[Channel]
+    ) -> None:
+        """Set display name of 1-1 chats, resolve all usernames in one request"""
+        direct = {
+            channel.id: direct_user(channel.name, user_id)
+            for channel in channels
+            if not channel.display_name and "__" in channel.name
+        }
+
+        if direct:
+            mm.resolve_users(direct.values())
+
+        for channel in channels:
+            if channel.id in direct:
+                channel.display_name = mm.get_user(direct[channel.id])
+
+    def posted(
+        self, mm: Mattermost, user_id: str, post: dict[str, Any], data: dict[str, Any]
+    ) -> None:
+        """Update state from websocket `posted` event"""
+        channel_id = post.get("channel_id")
+
+        if not channel_id:
+            return
+
+        channel = self.state.get(channel_id)
+
+        if not channel:
+            # New channel or direct message, not seen in state before
+            channel_type = data.get("channel_type")
+            channel = Channel(
+                id=channel_id,
+                type=channel_type,
+                team_id=data.get("team_id") or "",
+                # Display name of 1-1 chats is looked up in refresh()
+                display_name=None
+                if channel_type == "D"
+                else data.get("channel_display_name"),
+                name=data.get("channel_name", ""),
+                mention_count=0,
+                msg_count=0,
+                total_msg_count=0,
+            )
+            self.state[channel_id] = channel
+
+        was_unread = bool(channel.msg_unread_count)
+
+        channel.total_msg_count = (channel.total_msg_count or 0) + 1
+        channel.last_post_at = post.get("create_at", channel.last_post_at)
+
+        if post.get("user_id") == user_id:
+            # Posting in a channel marks it as read
+            channel.msg_count = channel.total_msg_count
+            channel.mention_count = 0
+        elif user_id in (data.get("mentions") or []):
+            channel.mention_count = (channel.mention_count or 0) + 1
+
+        # Only the list of unread channels needs to be updated, not all of state
+        if channel.msg_unread_count and not was_unread:
+            self.resolve_names(mm, user_id, [channel])
             self.channels.append(channel)
+        elif was_unread and not channel.msg_unread_count:
+            self.channels = [c for c in self.channels if c is not channel]
+
+    def viewed(self, channel_id: str) -> None:
+        """Update state from websocket `channel_viewed` event"""
+        channel = self.state.get(channel_id)
+
+        if channel:
+            channel.msg_count = channel.total_msg_count
+            channel.mention_count = 0
+
+        self.channels = [
+            channel for channel in self.channels if channel.id != channel_id
+        ]
 
     def debug(self) -> None:
         """Debug output of channels"""
@@ -146,3 +953,11 @@ class User(BaseModel):
     username: str
     first_name: str
     last_name: str
+
+
+class Session(BaseModel):
+    """Cached login session"""
+
+    token: str
+    user: User
+    teams: list[dict[str, Any]]
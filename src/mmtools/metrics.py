@@ -0,0 +1,232 @@
+"""mmtools - metrics
+
+Counters and histograms in the Prometheus text format, served on a local
+HTTP endpoint (--metrics-port) and/or written to a file for the node
+exporter textfile collector (--metrics-file).
+
+Metrics are disabled unless one of the options is set, and then every
+call to inc()/observe() returns immediately.
+"""
+
+import atexit
+import os
+import re
+import threading
+import time
+from logging import debug, info, warning
+from pathlib import Path
+
+ENABLED = False
+
+# Upper bounds (seconds) of histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Seconds between writes to the metrics file, for the long running tools
+WRITE_INTERVAL = 15.0
+
+HELP = {
+    "mmtools_rest_requests_total": (
+        "counter",
+        "REST requests by endpoint and status code",
+    ),
+    "mmtools_rest_request_seconds": (
+        "histogram",
+        "REST request latency (until response headers) by endpoint",
+    ),
+    "mmtools_logins_total": ("counter", "Full logins (password)"),
+    "mmtools_channel_updates_total": (
+        "counter",
+        "Channel updates, full or incremental (ETag)",
+    ),
+    "mmtools_channel_update_seconds": ("histogram", "Channel update duration"),
+    "mmtools_websocket_events_total": ("counter", "Websocket events by type"),
+    "mmtools_event_handler_seconds": (
+        "histogram",
+        "Processing time of handled websocket events by type",
+    ),
+    "mmtools_websocket_reconnects_total": ("counter", "Websocket reconnects"),
+    "mmtools_replayed_posts_total": (
+        "counter",
+        "Posts missed while disconnected, replayed after reconnect",
+    ),
+    "mmtools_notifications_total": (
+        "counter",
+        "Notifications sent, urgent for mentions",
+    ),
+    "mmtools_signals_total": ("counter", "Signals sent to the --pkill process"),
+    "mmtools_broker_dropped_total": (
+        "counter",
+        "Events dropped for local subscribers that did not keep up (--broker)",
+    ),
+    "mmtools_user_cache_hits_total": ("counter", "Usernames found in cache"),
+    "mmtools_user_cache_misses_total": (
+        "counter",
+        "Usernames requested from the server",
+    ),
+}
+
+# Mattermost ids (26 characters) in REST endpoints
+ID = re.compile(r"/[a-z0-9]{26}(?=/|$)")
+
+Labels = tuple[tuple[str, str], ...]
+
+lock = threading.Lock()
+counters: dict[tuple[str, Labels], float] = {}
+# Bucket counts, followed by count and sum
+histograms: dict[tuple[str, Labels], list[float]] = {}
+
+
+def inc(name: str, value: float = 1, **labels: str) -> None:
+    """Increment counter"""
+    if not ENABLED:
+        return
+
+    key = (name, tuple(sorted(labels.items())))
+
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, **labels: str) -> None:
+    """Add observation to histogram"""
+    if not ENABLED:
+        return
+
+    key = (name, tuple(sorted(labels.items())))
+
+    with lock:
+        histogram = histograms.get(key)
+
+        if histogram is None:
+            histogram = histograms[key] = [0.0] * (len(BUCKETS) + 2)
+
+        for n, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[n] += 1
+
+        histogram[-2] += 1
+        histogram[-1] += seconds
+
+
+def endpoint(path: str) -> str:
+    """REST endpoint of request path, with ids replaced (bounded label values)"""
+    path = path.split("?", 1)[0].removeprefix("/api/v4")
+    return ID.sub("/{id}", path)
+
+
+def escape(value: str) -> str:
+    """Escape label value"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Labels, extra: tuple[str, str] | None = None) -> str:
+    """Labels in the text format"""
+    pairs = labels + ((extra,) if extra else ())
+
+    if not pairs:
+        return ""
+
+    values = ",".join(f'{key}="{escape(value)}"' for key, value in pairs)
+    return f"{{{values}}}"
+
+
+def format_value(value: float) -> str:
+    """Sample value, without losing precision (counters grow without bound)"""
+    return repr(float(value))
+
+
+def render() -> str:
+    """All metrics in the Prometheus text format"""
+    with lock:
+        samples = sorted(counters.items()) + sorted(
+            (key, list(value)) for key, value in histograms.items()
+        )
+
+    lines = []
+    described = set()
+
+    for (name, labels), value in samples:
+        if name not in described:
+            (kind, description) = HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            described.add(name)
+
+        if not isinstance(value, list):
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+            continue
+
+        for bound, count in zip(BUCKETS, value, strict=False):
+            lines.append(
+                f"{name}_bucket{format_labels(labels, ('le', f'{bound:g}'))} {format_value(count)}"
+            )
+        lines.append(
+            f"{name}_bucket{format_labels(labels, ('le', '+Inf'))} {format_value(value[-2])}"
+        )
+        lines.append(f"{name}_count{format_labels(labels)} {format_value(value[-2])}")
+        lines.append(f"{name}_sum{format_labels(labels)} {format_value(value[-1])}")
+
+    return "\n".join(lines) + "\n"
+
+
+def write(path: str) -> None:
+    """Write metrics to file (atomically, as the textfile collector requires)"""
+    tmp = Path(f"{path}.{os.getpid()}.tmp")
+    try:
+        tmp.write_text(render())
+        tmp.replace(path)
+    except OSError as e:
+        warning("Unable to write metrics to %s: %s", path, e)
+
+
+def serve(port: int) -> None:
+    """Serve metrics on http://127.0.0.1:<port>/metrics in a background thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args: object) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    info("serving metrics on http://127.0.0.1:%s/metrics", port)
+
+
+def setup(port: int = 0, path: str | None = None) -> None:
+    """
+    Enable metrics if port or path is set. The file is written on exit, and
+    every WRITE_INTERVAL seconds while the process is running
+    """
+    global ENABLED
+
+    if not (port or path):
+        return
+
+    ENABLED = True
+
+    if port:
+        try:
+            serve(port)
+        except OSError as e:
+            warning("Unable to serve metrics on port %s: %s", port, e)
+
+    if path:
+        debug("writing metrics to %s", path)
+        atexit.register(write, path)
+
+        def writer() -> None:
+            while True:
+                time.sleep(WRITE_INTERVAL)
+                write(path)
+
+        threading.Thread(target=writer, daemon=True).start()
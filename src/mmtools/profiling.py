@@ -0,0 +1,199 @@
+"""mmtools - profiling of a status poll (--profile)
+
+Records a tree of timed phases (login, channel requests, parsing, ...) with
+the REST requests made in each phase and the bytes transferred. The tree is
+printed to stderr when the profile is finished, and can be written as a
+speedscope profile (--profile-output <file>.json) or, for any other file
+name, as cProfile statistics (pstats) of the same run.
+
+Requests made from worker threads are added to the phase the main thread is in.
+"""
+
+import atexit
+import contextlib
+import json
+import sys
+import threading
+import time
+from collections.abc import Iterator
+from logging import info
+from pathlib import Path
+from typing import Any
+
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+
+class Phase:
+    """Timed phase, with nested phases and requests"""
+
+    __slots__ = ("name", "start", "end", "bytes", "children")
+
+    def __init__(self, name: str, start: float) -> None:
+        self.name = name
+        self.start = start
+        self.end: float | None = None
+        self.bytes = 0
+        self.children: list[Phase] = []
+
+    @property
+    def seconds(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    @property
+    def total_bytes(self) -> int:
+        return self.bytes + sum(child.total_bytes for child in self.children)
+
+    @property
+    def requests(self) -> int:
+        own = 1 if self.name.startswith(("GET ", "POST ", "PUT ", "DELETE ")) else 0
+        return own + sum(child.requests for child in self.children)
+
+    def lines(self, depth: int = 0) -> Iterator[str]:
+        """Tree as lines of text"""
+        details = f"{self.seconds * 1000:9.1f}ms"
+        if self.total_bytes:
+            details += f" {self.total_bytes:>10,}B"
+        if self.requests and self.children:
+            details += f" ({self.requests} request{'s' if self.requests > 1 else ''})"
+        yield f"{details}  {'  ' * depth}{self.name}"
+
+        for child in self.children:
+            yield from child.lines(depth + 1)
+
+
+class Profiler:
+    """Phase tree of one run, and optionally cProfile"""
+
+    def __init__(self, name: str, output: str | None) -> None:
+        self.lock = threading.Lock()
+        self.root = Phase(name, time.perf_counter())
+        self.stack = [self.root]
+        self.output = output
+        self.cprofile: Any = None
+
+        if output and not output.endswith(".json"):
+            import cProfile
+
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Record phase, nested in the current phase"""
+        phase = Phase(name, time.perf_counter())
+
+        with self.lock:
+            self.stack[-1].children.append(phase)
+            self.stack.append(phase)
+        try:
+            yield
+        finally:
+            phase.end = time.perf_counter()
+            with self.lock:
+                self.stack.remove(phase)
+
+    def request(self, name: str, seconds: float, size: int) -> None:
+        """Add finished request to the current phase"""
+        end = time.perf_counter()
+        phase = Phase(name, end - seconds)
+        phase.end = end
+        phase.bytes = size
+
+        with self.lock:
+            self.stack[-1].children.append(phase)
+
+    def finish(self) -> None:
+        """Stop recording, print tree and write output file"""
+        self.root.end = time.perf_counter()
+
+        if self.cprofile:
+            self.cprofile.disable()
+
+        print("\n".join(self.root.lines()), file=sys.stderr)
+
+        if not self.output:
+            return
+
+        if self.cprofile:
+            self.cprofile.dump_stats(self.output)
+        else:
+            Path(self.output).write_text(json.dumps(self.speedscope()))
+
+        info("profile written to %s", self.output)
+
+    def speedscope(self) -> dict[str, Any]:
+        """Phase tree as a speedscope (evented) profile"""
+        frames: dict[str, int] = {}
+        events: list[dict[str, Any]] = []
+        start = self.root.start
+
+        def add(phase: Phase) -> None:
+            frame = frames.setdefault(phase.name, len(frames))
+            events.append({"type": "O", "frame": frame, "at": phase.start - start})
+            for child in phase.children:
+                add(child)
+            events.append(
+                {"type": "C", "frame": frame, "at": (phase.end or phase.start) - start}
+            )
+
+        add(self.root)
+
+        # Requests in worker threads may overlap, speedscope requires nesting
+        last = 0.0
+        for event in events:
+            event["at"] = last = max(last, event["at"])
+
+        return {
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": self.root.name,
+            "exporter": "mmtools",
+            "shared": {"frames": [{"name": name} for name in frames]},
+            "profiles": [
+                {
+                    "type": "evented",
+                    "name": self.root.name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": last,
+                    "events": events,
+                }
+            ],
+        }
+
+
+PROFILER: Profiler | None = None
+
+NOT_PROFILING = contextlib.nullcontext()
+
+
+def phase(name: str) -> contextlib.AbstractContextManager[None]:
+    """Record phase if profiling, otherwise a no-op context manager"""
+    if PROFILER is None:
+        return NOT_PROFILING
+
+    return PROFILER.phase(name)
+
+
+def request(name: str, seconds: float, size: int) -> None:
+    """Record request if profiling"""
+    if PROFILER is not None:
+        PROFILER.request(name, seconds, size)
+
+
+def setup(name: str, output: str | None = None) -> None:
+    """Start profiling, the profile is finished on exit if not finished before"""
+    global PROFILER
+
+    PROFILER = Profiler(name, output)
+    atexit.register(finish)
+
+
+def finish() -> None:
+    """Finish profiling (if started), only the first call has any effect"""
+    global PROFILER
+
+    if PROFILER is None:
+        return
+
+    (profiler, PROFILER) = (PROFILER, None)
+    profiler.finish()
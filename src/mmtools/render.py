@@ -0,0 +1,367 @@
+"""mmtools - render status bar output
+
+Status and error output of the status tools, in the i3blocks, polybar, waybar
+and json formats
+"""
+
+import json
+import sys
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from typing import Any
+
+from mmtools.channel import Channel
+
+
+@dataclass(slots=True)
+class Entry:
+    """Channel with unread messages, as shown by the status tools"""
+
+    name: str
+    type: str
+    team: str
+    unread: int
+    mentions: int
+    account: str = ""
+
+    def __str__(self) -> str:
+        """<name>:<unread>, with @<mentions> if mentioned (except direct messages)"""
+        if self.mentions and self.type != "D":
+            return f"{self.name}:{self.unread}@{self.mentions}"
+
+        return f"{self.name}:{self.unread}"
+
+
+@dataclass(slots=True)
+class Summary:
+    """
+    Unread state of one or more accounts, aggregated in one pass over the
+    channels: direct messages (private), channels where we are mentioned and
+    other channels, with unread messages per channel type (D/G/O/P) and team
+    """
+
+    private: list[Entry] = field(default_factory=list)
+    other: list[Entry] = field(default_factory=list)
+    mentions: list[Entry] = field(default_factory=list)
+    types: dict[str, int] = field(default_factory=dict)
+    teams: dict[str, int] = field(default_factory=dict)
+
+    def merge(self, summary: "Summary") -> "Summary":
+        """Add summary (of another account)"""
+        self.private += summary.private
+        self.other += summary.other
+        self.mentions += summary.mentions
+
+        for counts, add in ((self.types, summary.types), (self.teams, summary.teams)):
+            for key, count in add.items():
+                counts[key] = counts.get(key, 0) + count
+
+        return self
+
+    def key(self) -> tuple[tuple[str, int, int], ...]:
+        """Everything the formatters show, to detect changes"""
+        return tuple(
+            (entry.name, entry.unread, entry.mentions)
+            for entries in (self.private, self.other, self.mentions)
+            for entry in entries
+        )
+
+    def as_dict(self) -> dict[str, Any]:
+        """Summary for the json output"""
+        channels = self.other + self.mentions + self.private
+
+        return {
+            "unread": sum(entry.unread for entry in channels),
+            "mentions": sum(entry.mentions for entry in channels),
+            "types": self.types,
+            "teams": self.teams,
+            "channels": [
+                {
+                    "name": entry.name,
+                    "type": entry.type,
+                    "team": entry.team,
+                    "account": entry.account,
+                    "unread": entry.unread,
+                    "mentions": entry.mentions,
+                }
+                for entry in channels
+            ],
+        }
+
+
+def summarize(
+    channels: list[Channel], shown: Callable[[Channel], bool], prefix: str = ""
+) -> Summary:
+    """
+    Aggregate channels with unread messages (that are shown by the channel
+    rules) in one pass. Channel names are prefixed with prefix (the name of
+    additional accounts)
+    """
+    summary = Summary()
+    account = prefix.rstrip("/")
+
+    for channel in channels:
+        unread = channel.msg_unread_count
+
+        if not unread or not shown(channel):
+            continue
+
+        channel_type = channel.type or ""
+        entry = Entry(
+            f"{prefix}{channel.display_name}",
+            channel_type,
+            channel.team_id,
+            unread,
+            channel.mention_count or 0,
+            account,
+        )
+
+        # channel.type == D (Direct)
+        if channel_type == "D":
+            summary.private.append(entry)
+        elif entry.mentions:
+            summary.mentions.append(entry)
+        else:
+            summary.other.append(entry)
+
+        summary.types[channel_type] = summary.types.get(channel_type, 0) + unread
+
+        if channel.team_id:
+            summary.teams[channel.team_id] = (
+                summary.teams.get(channel.team_id, 0) + unread
+            )
+
+    return summary
+
+
+class RenderCache:
+    """
+    Output of a formatter, only rendered again when the summary has changed.
+    Used by the long running tools, that render on every poll or event
+    """
+
+    def __init__(self, render: Callable[[Summary], str]) -> None:
+        self.render = render
+        self.last: tuple[tuple[str, int, int], ...] | None = None
+        self.output = ""
+
+    def __call__(self, summary: Summary) -> tuple[str, bool]:
+        """Output, and True if it was rendered again"""
+        key = summary.key()
+
+        if key == self.last:
+            return (self.output, False)
+
+        self.last = key
+        self.output = self.render(summary)
+
+        return (self.output, True)
+
+
+def age(seconds: float) -> str:
+    """Short human readable age"""
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= size:
+            return f"{int(seconds // size)}{unit}"
+
+    return f"{int(seconds)}s"
+
+
+def i3blocks(
+    summary: Summary,
+    chat_prefix: str,
+    user_color: str,
+    channel_color: str,
+    mention_color: str = "",
+) -> str:
+    """Channel status in i3blocks format (full text, short text and color)"""
+    out = chat_prefix
+
+    # Join all channels with pipe
+    msg = " | ".join(map(str, summary.other + summary.mentions + summary.private))
+
+    # If we have prefix and output - insert space between prefix and output
+    if msg and chat_prefix:
+        msg = " " + msg
+
+    lines = [out + msg, out + msg]
+
+    if summary.private:
+        lines.append(user_color)
+    elif summary.mentions:
+        lines.append(mention_color or user_color)
+    elif summary.other:
+        lines.append(channel_color)
+
+    return "\n".join(lines)
+
+
+def polybar(
+    summary: Summary,
+    chat_prefix: str,
+    user_color: str,
+    channel_color: str,
+    mention_color: str = "",
+) -> str:
+    """Channel status in polybar format"""
+    mention_color = mention_color or user_color
+    private = [f"%{{F{user_color}}}{entry}" for entry in summary.private]
+    other = [f"%{{F{channel_color}}}{entry}" for entry in summary.other]
+    mentions = [f"%{{F{mention_color}}}{entry}" for entry in summary.mentions]
+
+    if mentions:
+        out = f"%{{F{mention_color}}}{chat_prefix}"
+    elif other:
+        out = f"%{{F{channel_color}}}{chat_prefix}"
+    elif private:
+        out = f"%{{F{user_color}}}{chat_prefix}"
+    else:
+        out = chat_prefix
+
+    # Join all channels with pipe
+    msg = " | ".join(other + mentions + private)
+
+    # If we have prefix and output - insert space between prefix and output
+    if msg and chat_prefix:
+        msg = " " + msg
+
+    return out + msg
+
+
+def waybar(summary: Summary, chat_prefix: str, stale: bool = False) -> str:
+    """
+    Channel status in waybar (json) format, with class mention if we are
+    mentioned and class stale for old status
+    """
+    klass: str | list[str]
+    if summary.private:
+        klass = "private"
+    else:
+        klass = "other"
+
+    extra = [
+        name
+        for (name, enabled) in (("mention", summary.mentions), ("stale", stale))
+        if enabled
+    ]
+
+    if extra:
+        klass = [klass, *extra]
+
+    # Join all channels with pipe
+    msg = " | ".join(map(str, summary.other + summary.mentions + summary.private))
+
+    # If we have prefix and output - insert space between prefix and output
+    # (the prefix ends with the age if the status is stale)
+    if msg and chat_prefix:
+        msg = " " + msg
+
+    return json.dumps({"text": chat_prefix + msg, "class": klass})
+
+
+def as_json(summary: Summary, age: float | None = None) -> str:
+    """
+    Unread state as json: totals, unread messages per channel type and team,
+    and all unread channels. age is set (seconds) for the last known status
+    """
+    return json.dumps({**summary.as_dict(), "stale": age is not None, "age": age})
+
+
+@dataclass(frozen=True, slots=True)
+class Style:
+    """Output options of the status tools"""
+
+    chat_prefix: str
+    user_color: str = ""
+    channel_color: str = ""
+    mention_color: str = ""
+    stale_marker: str = ""
+
+    def prefix(self, stale_age: float | None) -> str:
+        """Chat prefix, marked with the age if the status is stale"""
+        if stale_age is None:
+            return self.chat_prefix
+
+        return f"{self.chat_prefix} {self.stale_marker}{age(stale_age)}".strip()
+
+
+@dataclass(frozen=True, slots=True)
+class Format:
+    """
+    Output format of a status tool: status renders a summary (stale_age is
+    None if the status is current), and error renders an error message
+    """
+
+    status: Callable[[Summary, Style, float | None], str]
+    error: Callable[[Style, str], str]
+
+
+def i3blocks_status(summary: Summary, style: Style, stale_age: float | None) -> str:
+    """i3blocks status, with the age in the prefix if stale"""
+    return i3blocks(
+        summary,
+        style.prefix(stale_age),
+        style.user_color,
+        style.channel_color,
+        style.mention_color,
+    )
+
+
+def i3blocks_error(style: Style, message: str) -> str:
+    """i3blocks error, in red"""
+    msg = f"{style.chat_prefix} {message}"
+    return f"{msg}\n{msg}\n#FF0000"
+
+
+def polybar_status(summary: Summary, style: Style, stale_age: float | None) -> str:
+    """polybar status, with the age in the prefix if stale"""
+    return polybar(
+        summary,
+        style.prefix(stale_age),
+        style.user_color,
+        style.channel_color,
+        style.mention_color,
+    )
+
+
+def polybar_error(style: Style, message: str) -> str:
+    """polybar error, in the channel color"""
+    return f"%{{F{style.channel_color}}}{style.chat_prefix} {message}"
+
+
+def waybar_status(summary: Summary, style: Style, stale_age: float | None) -> str:
+    """waybar status, with the age in the prefix and class stale if stale"""
+    return waybar(summary, style.prefix(stale_age), stale=stale_age is not None)
+
+
+def waybar_error(style: Style, message: str) -> str:
+    """waybar error, with class error"""
+    return json.dumps({"text": message, "class": "error"})
+
+
+def json_status(summary: Summary, style: Style, stale_age: float | None) -> str:
+    """json status, with the age if stale"""
+    return as_json(summary, stale_age)
+
+
+def json_error(style: Style, message: str) -> str:
+    """json error"""
+    return json.dumps({"error": message})
+
+
+# Output formats by name. A new format only needs an entry here, and an entry
+# point calling faststart.run (or status.run)
+FORMATS = {
+    "i3blocks": Format(i3blocks_status, i3blocks_error),
+    "polybar": Format(polybar_status, polybar_error),
+    "waybar": Format(waybar_status, waybar_error),
+    "json": Format(json_status, json_error),
+}
+
+
+def flush_stdout() -> None:
+    """Flush output, the status bar may already have closed the pipe"""
+    try:
+        sys.stdout.flush()
+    except BrokenPipeError:
+        pass
@@ -0,0 +1,198 @@
+"""mmtools - channel rules
+
+Rules to include/exclude channels, one rule per line (or separated by ";"):
+
+    <include|exclude> <field>=<value>
+
+where field is one of
+
+- id: channel id
+- type: channel type (O=public, P=private, D=direct, G=group), case
+  insensitive
+- team: team id, name or display name
+- name: regular expression, searched in the channel name (and the username
+  of 1-1 chats)
+
+The first matching rule decides if the channel is shown. Channels that do not
+match any rule are shown. The `ignore` option is the same as a last rule
+`exclude name=<ignore>`.
+"""
+
+import itertools
+import re
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
+from typing import Any
+
+from mmtools.channel import Channel
+
+FIELDS = ("id", "type", "team", "name")
+
+
+@dataclass(slots=True, frozen=True)
+class Rule:
+    """Include/exclude rule"""
+
+    include: bool
+    field: str
+    value: str
+
+    @classmethod
+    def parse(cls, rule: str) -> "Rule":
+        """Parse rule, raises ValueError if invalid"""
+        try:
+            (action, expression) = rule.split(maxsplit=1)
+            (field, value) = expression.split("=", 1)
+        except ValueError:
+            raise ValueError(
+                f"Invalid rule, expected <action> <field>=<value>: {rule}"
+            ) from None
+
+        action = action.lower()
+        field = field.strip().lower()
+        value = value.strip()
+
+        if action not in ("include", "exclude"):
+            raise ValueError(f"Invalid action in rule (include/exclude): {rule}")
+
+        if not value:
+            raise ValueError(f"Missing value in rule: {rule}")
+
+        if field not in FIELDS:
+            raise ValueError(f"Invalid field in rule ({', '.join(FIELDS)}): {rule}")
+
+        if field == "type":
+            value = value.upper()
+        elif field == "name":
+            try:
+                re.compile(value)
+            except re.error as e:
+                raise ValueError(
+                    f"Invalid regular expression in rule {rule}: {e}"
+                ) from e
+
+        return cls(action == "include", field, value)
+
+
+def parse(rules: str | None, ignore: str | None = None) -> list[Rule]:
+    """Parse rules, and the ignore regular expression. Raises ValueError if invalid"""
+    result = [
+        Rule.parse(rule)
+        for line in (rules or "").splitlines()
+        for rule in line.split(";")
+        if rule.strip()
+    ]
+
+    if ignore:
+        result.append(Rule.parse(f"exclude name={ignore}"))
+
+    return result
+
+
+class RuleGroup:
+    """
+    Consecutive rules with the same action. The group matches if any of the
+    rules match, so ids, types and teams are looked up in sets. Regular
+    expressions are searched one by one, since combining them would renumber
+    their groups (and break backreferences). The verdict cache of ChannelFilter
+    keeps that cheap
+    """
+
+    __slots__ = ("include", "ids", "types", "teams", "regexes")
+
+    def __init__(self, include: bool, rules: list[Rule]) -> None:
+        self.include = include
+        self.ids = {rule.value for rule in rules if rule.field == "id"}
+        self.types = {rule.value for rule in rules if rule.field == "type"}
+        self.teams = {rule.value for rule in rules if rule.field == "team"}
+
+        self.regexes = [
+            re.compile(rule.value) for rule in rules if rule.field == "name"
+        ]
+
+    def match(
+        self, channel: Channel, team_names: Callable[[], dict[str, set[str]]]
+    ) -> bool:
+        """Does any rule match channel. team_names is only called for team rules"""
+        if channel.id in self.ids or channel.type in self.types:
+            return True
+
+        if (
+            self.teams
+            and channel.team_id
+            and (
+                channel.team_id in self.teams
+                or not self.teams.isdisjoint(team_names().get(channel.team_id, ()))
+            )
+        ):
+            return True
+
+        for regex in self.regexes:
+            if regex.search(channel.name) or (
+                # Also match username of 1-1 chats
+                channel.type == "D"
+                and channel.display_name
+                and regex.search(channel.display_name)
+            ):
+                return True
+
+        return False
+
+
+class ChannelFilter:
+    """
+    Decides which channels are shown. The verdict is cached per channel id,
+    and only evaluated again if the channel is renamed.
+
+    Teams (list of team objects from the API) are only loaded if a rule
+    matches on team, and only once
+    """
+
+    def __init__(
+        self,
+        rules: list[Rule],
+        teams: Callable[[], Iterable[dict[str, Any]] | None] | None = None,
+    ) -> None:
+        self.groups = [
+            RuleGroup(include, list(group))
+            for (include, group) in itertools.groupby(rules, lambda rule: rule.include)
+        ]
+        self.load_teams = teams
+        self.teams: dict[str, set[str]] | None = None
+        self.verdicts: dict[str, tuple[str, str | None, bool]] = {}
+
+    def team_names(self) -> dict[str, set[str]]:
+        """Team id -> team name and display name"""
+        if self.teams is None:
+            teams = (self.load_teams() if self.load_teams else None) or ()
+            self.teams = {
+                team["id"]: {team.get("name") or "", team.get("display_name") or ""}
+                for team in teams
+            }
+        return self.teams
+
+    def __call__(self, channel: Channel) -> bool:
+        """Is channel shown"""
+        if not self.groups:
+            return True
+
+        verdict = self.verdicts.get(channel.id)
+
+        if (
+            verdict
+            and verdict[0] == channel.name
+            and verdict[1] == channel.display_name
+        ):
+            return verdict[2]
+
+        shown = next(
+            (
+                group.include
+                for group in self.groups
+                if group.match(channel, self.team_names)
+            ),
+            True,
+        )
+        self.verdicts[channel.id] = (channel.name, channel.display_name, shown)
+
+        return shown
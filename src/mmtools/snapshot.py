@@ -0,0 +1,51 @@
+"""mmtools - last known unread state
+
+The unread channels of the last successful status poll are saved per
+account. When the server is slow or not reachable, the status tools show
+this state, marked as stale, instead of only an error message.
+"""
+
+import dataclasses
+import time
+from pathlib import Path
+
+from mmtools import cache
+from mmtools.channel import Channel
+
+
+def snapshot_file(server: str, port: int, user: str) -> Path:
+    """Snapshot file of account"""
+    return cache.cache_file("snapshot", server, str(port), user)
+
+
+def save(filename: Path, channels: list[Channel]) -> None:
+    """Save unread channels, with the current time"""
+    cache.write_json(
+        filename,
+        {
+            "time": time.time(),
+            "channels": [
+                dataclasses.asdict(channel)
+                for channel in channels
+                if channel.msg_unread_count
+            ],
+        },
+    )
+
+
+def load(filename: Path, max_age: float) -> tuple[list[Channel], float] | None:
+    """
+    Unread channels and age (seconds) of snapshot. Returns None if there is
+    no snapshot, or if it is older than max_age seconds
+    """
+    data = cache.read_json(filename)
+
+    try:
+        age = time.time() - data["time"]
+
+        if age > max_age:
+            return None
+
+        return ([Channel(**channel) for channel in data["channels"]], age)
+    except (TypeError, KeyError):
+        return None
@@ -1,19 +1,38 @@
 """mmtools - status"""
 
-import json
-import re
+import asyncio
+import os
+import signal
+import subprocess
 import sys
+import threading
 import time
-from collections.abc import Callable
-from typing import cast
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from logging import debug, warning
+from typing import NoReturn, cast
 
 import requests
 import urllib3
 from pydantic import Field
 
-from mmtools import arguments
+from mmtools import (
+    arguments,
+    cache,
+    connection,
+    daemon,
+    events,
+    faststart,
+    profiling,
+    render,
+    rules,
+    snapshot,
+)
 from mmtools.mattermost import Mattermost
 
+# Unread state, and False on errors
+Status = tuple[render.Summary, bool]
+
 
 class Config(arguments.Config):
     channel_color: str = Field(
@@ -23,171 +42,648 @@ class Config(arguments.Config):
     user_color: str = Field(
         "#fb4934", description="Color to use if unread user messages"
     )
+    mention_color: str = Field(
+        "#fabd2f", description="Color to use if mentioned in group messages"
+    )
     sleep: int = Field(
         30,
         description="Time to sleep between updates for polybar",
     )
+    sleep_min: int = Field(
+        5,
+        description="Time to sleep between updates for polybar, when unread messages change",
+    )
+    sleep_max: int = Field(
+        300,
+        description="Max time to sleep between updates for polybar, when nothing changes or the screen is locked/idle",
+    )
+    stream: bool = Field(
+        False,
+        description="Keep a websocket open, and print status when it changes (polybar/waybar)",
+    )
+    deadline: float = Field(
+        10.0,
+        description="Seconds to wait for the server before the last known status is shown (0=no deadline)",
+    )
+    stale_max_age: int = Field(
+        86400,
+        description="Max age (seconds) of the last known status, shown when the server is slow or not reachable",
+    )
+    stale_marker: str = Field(
+        "⏳",
+        description="Shown with the age of the last known status, after the chat prefix",
+    )
+
 
+class StatusError(Exception):
+    """Status could not be fetched, with message for the status bar"""
+
+
+def raise_error(args: Config, message: str) -> NoReturn:
+    """Error handler for the one-shot tools, the error is shown by the caller"""
+    raise StatusError(message)
+
+
+def init_mattermost(
+    args: Config,
+    error: Callable[[Config, str], None],
+    deadline: connection.Deadline | None = None,
+) -> Mattermost:
+    backoff = connection.Backoff(args.backoff_initial, args.backoff_max)
 
-def init_mattermost(args: Config, error: Callable[[Config, str], None]) -> Mattermost:
     while True:
         try:
-            return Mattermost(args)
-        except requests.exceptions.ReadTimeout as e:
+            with profiling.phase("init_mattermost"):
+                return Mattermost(args, deadline)
+        except requests.exceptions.Timeout as e:
             error(args, f"Timeout {e}")
-            time.sleep(5)
+            time.sleep(backoff.delay())
         except (
             requests.exceptions.ConnectionError,
             urllib3.exceptions.NewConnectionError,
         ):
             error(args, "Connection error")
-            time.sleep(5)
+            time.sleep(backoff.delay())
         except Exception as e:
             error(args, f"Unknown exception: {e}")
             sys.exit(1)
 
+        # Every attempt gets a new time budget
+        if deadline:
+            deadline = connection.Deadline(args.deadline)
+
+
+def channel_filter(args: Config) -> rules.ChannelFilter:
+    """Channel filter from config"""
+    return faststart.channel_filter(
+        args.channel_rules, args.ignore, args.server, args.port, args.user
+    )
+
+
+def daemon_status(
+    args: Config, shown: rules.ChannelFilter, prefix: str = ""
+) -> Status | None:
+    """Get status from running mmwatch, returns None if mmwatch is not running"""
+    if args.no_daemon:
+        return None
+
+    with profiling.phase("daemon status"):
+        channels = daemon.query(
+            daemon.socket_path(args.server, args.port, args.user, args.socket)
+        )
+
+    if channels is None:
+        return None
+
+    return (render.summarize(channels, shown, prefix), True)
+
 
 def get_status(
-    args: Config, mm: Mattermost, error: Callable[[Config, str], None]
-) -> tuple[list[str], list[str], bool]:
+    args: Config,
+    mm: Mattermost,
+    shown: rules.ChannelFilter,
+    error: Callable[[Config, str], None],
+    prefix: str = "",
+) -> Status:
     try:
-        channels = mm.init_channels()
-
-        # channel.type == D (Direct)
-        private = [
-            f"{channel.display_name}:{channel.msg_unread_count}"
-            for channel in channels.channels
-            if channel.msg_unread_count
-            and channel.type == "D"
-            and not (args.ignore and re.search(args.ignore, channel.name))
-        ]
-        other = [
-            f"{channel.display_name}:{channel.msg_unread_count}"
-            for channel in channels.channels
-            if channel.msg_unread_count
-            and channel.type != "D"
-            and not (args.ignore and re.search(args.ignore, channel.name))
-        ]
-
-        return (private, other, True)
-    except requests.exceptions.ReadTimeout:
+        with profiling.phase("get_status"):
+            channels = mm.init_channels()
+
+            with profiling.phase("summarize channels"):
+                summary = render.summarize(channels.channels, shown, prefix)
+
+            with profiling.phase("save snapshot"):
+                snapshot.save(
+                    snapshot.snapshot_file(args.server, args.port, args.user),
+                    channels.channels,
+                )
+
+        return (summary, True)
+    except requests.exceptions.Timeout:
         error(args, "Timeout")
     except (requests.exceptions.ConnectionError, urllib3.exceptions.NewConnectionError):
         error(args, "Connection error")
     except Exception as e:
         error(args, f"Unknown error: {e}")
 
-    return ([], [], False)
+    return (render.Summary(), False)
+
+
+def poll(args: Config, shown: rules.ChannelFilter) -> Status:
+    """
+    Status of the main account for the one-shot tools, from mmwatch if it is
+    running, and otherwise from the REST API. All requests share a time budget
+    of args.deadline seconds.
+
+    Concurrent invocations (e.g. several bars) share one poll: if another
+    invocation is polling the same account, wait for it to finish and use the
+    status it saved. Raises StatusError if there is no status
+    """
+    status = daemon_status(args, shown)
+
+    if status is not None:
+        return status
+
+    start = time.time()
+    lock_file = cache.cache_file(
+        "poll", args.server, str(args.port), args.user
+    ).with_suffix(".lock")
+
+    # Without a deadline, wait until the other invocation is done
+    with cache.lock(lock_file, args.deadline or None) as locked:
+        if locked:
+            deadline = connection.Deadline(args.deadline)
+            mm = init_mattermost(args, raise_error, deadline)
+            return get_status(args, mm, shown, raise_error)
+
+    saved = snapshot.load(
+        snapshot.snapshot_file(args.server, args.port, args.user),
+        time.time() - start,
+    )
+
+    if saved is None:
+        # The other invocation did not finish in time, or failed
+        raise StatusError("Timeout")
+
+    debug("status from concurrent poll")
+    return (render.summarize(saved[0], shown), True)
+
+
+class Account:
+    """
+    Additional account (--accounts). The status is merged with the status
+    of the main account, with channel names prefixed with the account name
+    """
+
+    def __init__(self, name: str, args: Config) -> None:
+        self.name = name
+        self.prefix = f"{name}/"
+        self.args = args
+        self.shown = channel_filter(args)
+        self.mm: Mattermost | None = None
+        # The last status was requested from the REST API (not from mmwatch)
+        self.rest = False
+
+    def error(self, args: Config, message: str) -> None:
+        """Errors are logged, and do not stop the status of other accounts"""
+        warning("account %s: %s", self.name, message)
+
+    def connect(self, deadline: connection.Deadline | None = None) -> Mattermost | None:
+        """Mattermost session, kept between polls. Returns None on errors"""
+        if not self.mm:
+            try:
+                self.mm = Mattermost(self.args, deadline)
+            except Exception as e:
+                self.error(self.args, f"Unable to connect: {e}")
+
+        return self.mm
+
+    def status(self) -> Status:
+        """Status from mmwatch, or from the REST API if mmwatch is not running"""
+        status = daemon_status(self.args, self.shown, self.prefix)
+        self.rest = status is None
+
+        if status is not None:
+            return status
+
+        deadline = connection.Deadline(self.args.deadline)
+        mm = self.connect(deadline)
+
+        if not mm:
+            return (render.Summary(), False)
+
+        mm.deadline = deadline
+
+        return get_status(self.args, mm, self.shown, self.error, self.prefix)
+
+
+def accounts() -> list[Account]:
+    """Additional accounts"""
+    return [
+        Account(name, cast(Config, args)) for (name, args) in arguments.ACCOUNTS.items()
+    ]
+
+
+def merged_status(main: Callable[[], Status], extra: list[Account]) -> Status:
+    """
+    Status of the main account, merged with the status of additional accounts.
+    All accounts are polled concurrently. Requests share the worker threads
+    and the session caches of the accounts, so only accounts without a valid
+    cached session need to login
+    """
+    if not extra:
+        return main()
+
+    with ThreadPoolExecutor(len(extra), thread_name_prefix="account") as pool:
+        pending = [pool.submit(account.status) for account in extra]
+        (summary, ok) = main()
+
+        for request in pending:
+            summary.merge(request.result()[0])
+
+    return (summary, ok)
+
+
+def with_deadline(deadline: float, func: Callable[[], Status]) -> Status | None:
+    """
+    Status from func, or None if it is not done within deadline seconds.
+    Exceptions are raised in the caller. The requests of func still run in
+    the worker threads of mattermost.EXECUTOR after the deadline, and are
+    joined at interpreter exit: use exit_after_deadline to exit without
+    waiting for them
+    """
+    # cProfile only profiles the thread it is enabled in
+    if not deadline or profiling.PROFILER:
+        return func()
+
+    result: list[Status] = []
+    errors: list[BaseException] = []
+
+    def run() -> None:
+        try:
+            result.append(func())
+        except BaseException as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, name="refresh", daemon=True)
+    thread.start()
+    thread.join(deadline)
+
+    if errors:
+        raise errors[0]
+
+    return result[0] if result else None
+
+
+def exit_after_deadline() -> NoReturn:
+    """
+    Exit at once after with_deadline returned None, without waiting for the
+    requests still running in the worker threads
+    """
+    render.flush_stdout()
+    os._exit(0)
+
+
+def last_status(args: Config) -> tuple[render.Summary, float] | None:
+    """
+    Last known status (unread state and age) of the main account, merged with
+    the last known status of additional accounts. Returns None if there is no
+    recent snapshot of the main account
+    """
+    (summary, age) = (render.Summary(), 0.0)
+    sources = [("", args)] + [
+        (f"{name}/", cast(Config, account))
+        for (name, account) in arguments.ACCOUNTS.items()
+    ]
+
+    for prefix, account in sources:
+        saved = snapshot.load(
+            snapshot.snapshot_file(account.server, account.port, account.user),
+            args.stale_max_age,
+        )
+
+        if saved is None:
+            if not prefix:
+                return None
+            continue
+
+        (channels, saved_age) = saved
+        summary.merge(render.summarize(channels, channel_filter(account), prefix))
+        age = max(age, saved_age)
+
+    return (summary, age)
+
+
+def style(args: Config) -> render.Style:
+    """Output options from config"""
+    return render.Style(
+        args.chat_prefix,
+        args.user_color,
+        args.channel_color,
+        args.mention_color,
+        args.stale_marker,
+    )
+
+
+def show_error(name: str) -> Callable[[Config, str], None]:
+    """
+    Error handler of output format name: shows the last known status (stale)
+    if any, and otherwise the error
+    """
+    output = render.FORMATS[name]
+
+    def error(args: Config, message: str) -> None:
+        stale = last_status(args)
+
+        if stale:
+            warning("%s, showing last known status", message)
+            (summary, age) = stale
+            print(output.status(summary, style(args), age))
+        else:
+            print(output.error(style(args), message))
+
+        render.flush_stdout()
+
+    return error
+
+
+def stream(
+    args: Config,
+    shown: rules.ChannelFilter,
+    output: Callable[[render.Summary], str],
+    error: Callable[[Config, str], None],
+) -> None:
+    """
+    Keep a websocket open, update unread state from events and print status
+    (rendered by output) only when it changes. Events that do not change the
+    shown state (e.g. posts in hidden channels) are not rendered.
+
+    Websockets of additional accounts are kept open on the same event loop.
+    Additional accounts that can not connect at startup are retried with
+    backoff, and shown once they are connected
+    """
+    mm = init_mattermost(args, error)
+    backoff = connection.Backoff(args.backoff_initial, args.backoff_max)
+
+    while not get_status(args, mm, shown, error)[1]:
+        time.sleep(backoff.delay())
+
+    sources = [(mm, shown, "")]
+    disconnected = []
+
+    for account in accounts():
+        account_mm = account.connect()
+
+        if account_mm:
+            get_status(account.args, account_mm, account.shown, account.error)
+            sources.append((account_mm, account.shown, account.prefix))
+        else:
+            disconnected.append(account)
+
+    rendered = render.RenderCache(output)
+
+    def update() -> None:
+        summary = render.Summary()
+
+        for source_mm, source_shown, prefix in sources:
+            summary.merge(
+                render.summarize(source_mm.channels.channels, source_shown, prefix)
+            )
+
+        (status, changed) = rendered(summary)
+
+        if not changed:
+            return
+
+        print(status)
+        render.flush_stdout()
+
+    def event_handler(mm: Mattermost) -> Callable[[str], Awaitable[None]]:
+        """Event handler for the websocket of mm"""
+
+        async def handler(event: str) -> None:
+            event_type = events.parse_event_type(event)
+
+            if event_type == "posted":
+                decoded = events.decode_event(event)
+                data = decoded["data"]
+
+                # Replayed posts (after reconnect) are already counted
+                if not decoded.get("replayed"):
+                    mm.channels.posted(mm, mm.user.id, data.get("post", {}), data)
+            elif event_type == "channel_viewed":
+                mm.channels.viewed(events.decode_event(event)["data"].get("channel_id"))
+            elif event_type == "multiple_channels_viewed":
+                data = events.decode_event(event)["data"]
+                for channel_id in data.get("channel_times", {}):
+                    mm.channels.viewed(channel_id)
+            elif event_type != "hello":
+                # Channels are updated before hello if the websocket is reconnected
+                return
+
+            update()
+
+        return handler
+
+    update()
+    profiling.finish()
+
+    async def reconnect(account: Account) -> None:
+        """Connect account that failed at startup, and watch its websocket"""
+        loop = asyncio.get_running_loop()
+        account_backoff = connection.Backoff(args.backoff_initial, args.backoff_max)
+
+        while True:
+            await asyncio.sleep(account_backoff.delay())
+            account_mm = await loop.run_in_executor(None, account.connect)
+
+            if account_mm:
+                break
+
+        await loop.run_in_executor(
+            None, get_status, account.args, account_mm, account.shown, account.error
+        )
+        sources.append((account_mm, account.shown, account.prefix))
+        update()
+
+        await account_mm.watch_websocket(event_handler(account_mm))
 
+    async def watch() -> None:
+        await asyncio.gather(
+            *(
+                source_mm.watch_websocket(event_handler(source_mm))
+                for (source_mm, _, _) in sources
+            ),
+            *(reconnect(account) for account in disconnected),
+        )
 
-def i3blocks_fatal(args: Config, message: str) -> None:
-    msg = f"{args.chat_prefix.strip()} {message}"
-    print(f"{msg}\n{msg}\n#FF0000")
-    sys.exit(0)
+    asyncio.run(watch())
+
+
+def run(name: str, streams: bool = True) -> None:
+    """
+    Output status in format name (see render.FORMATS), or keep printing it
+    when it changes (--stream, if the format streams). Shows the last known
+    status if the server does not answer within the deadline or the poll fails
+    """
+    args: Config = cast(
+        Config, arguments.handle_args(Config, "mmstatus", log_stream=sys.stderr)
+    )
+
+    shown = channel_filter(args)
+    output = render.FORMATS[name]
+    error = show_error(name)
+
+    if streams and args.stream:
+        stream(
+            args,
+            shown,
+            lambda summary: output.status(summary, style(args), None),
+            error,
+        )
+        return
+
+    try:
+        status = with_deadline(
+            args.deadline, lambda: merged_status(lambda: poll(args, shown), accounts())
+        )
+    except StatusError as e:
+        error(args, str(e))
+        return
+
+    if status is None:
+        error(args, "Timeout")
+        exit_after_deadline()
+
+    print(output.status(status[0], style(args), None))
+    render.flush_stdout()
+    profiling.finish()
 
 
 def i3blocks() -> None:
     """Output channel status in i3blocks format"""
+    # i3blocks reads three lines per update, so it does not stream
+    run("i3blocks", streams=False)
 
-    args: Config = cast(Config, arguments.handle_args(Config, "mmstatus"))
-    mm = init_mattermost(args, error=i3blocks_fatal)
-
-    (private, other, _) = get_status(args, mm, error=i3blocks_fatal)
 
-    out = args.chat_prefix
+# Signals that make mmpolybar refresh at once (mmwatch sends SIGUSR2 to --pkill)
+REFRESH_SIGNALS = {signal.SIGUSR1, signal.SIGUSR2}
 
-    # Join all channels with pipe
-    msg = " | ".join(other + private)
 
-    # If we have prefix and output - insert space between prefix and output
-    if msg and args.chat_prefix:
-        msg = " " + msg
+def wait_refresh(seconds: float) -> bool:
+    """
+    Sleep seconds, or until a refresh signal is received. The signals must be
+    blocked (pthread_sigmask). Returns True if signaled
+    """
+    return signal.sigtimedwait(REFRESH_SIGNALS, seconds) is not None
 
-    print(out + msg)
-    print(out + msg)
 
-    if private:
-        print(args.user_color)
-    elif other:
-        print(args.channel_color)
+def screen_idle() -> bool:
+    """
+    Is the session locked or idle (systemd-logind). Returns False if it is
+    not known
+    """
+    session = os.environ.get("XDG_SESSION_ID")
 
+    if not session:
+        return False
 
-def polybar_error(args: Config, message: str) -> None:
-    print(f"%{{F{args.channel_color}}}{args.chat_prefix} {message}")
+    try:
+        hints = subprocess.run(
+            [
+                "loginctl",
+                "show-session",
+                session,
+                "--property=LockedHint",
+                "--property=IdleHint",
+            ],
+            capture_output=True,
+            text=True,
+            timeout=1,
+        ).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+    return "=yes" in hints
 
 
 def polybar() -> None:
     """Output channel status in polybar format"""
 
-    args: Config = cast(Config, arguments.handle_args(Config, "mmstatus"))
+    # Refresh signals are received with sigtimedwait. Blocked before any
+    # thread is started (e.g. metrics), since threads inherit the mask
+    signal.pthread_sigmask(signal.SIG_BLOCK, REFRESH_SIGNALS)
 
-    ok = False
+    args: Config = cast(
+        Config, arguments.handle_args(Config, "mmstatus", log_stream=sys.stderr)
+    )
 
-    while True:
-        if not ok:
-            mm = init_mattermost(args, error=polybar_error)
+    shown = channel_filter(args)
+    polybar_error = show_error("polybar")
 
-        (private, other, ok) = get_status(args, mm, polybar_error)
+    def output(summary: render.Summary) -> str:
+        return render.polybar_status(summary, style(args), None)
 
-        if not ok:
-            time.sleep(args.sleep)
-            continue
+    if args.stream:
+        stream(args, shown, output, polybar_error)
+        return
 
-        private = [f"%{{F{args.user_color}}}{channel}" for channel in private]
-        other = [f"%{{F{args.channel_color}}}{channel}" for channel in other]
+    mm: Mattermost | None = None
+    backoff = connection.Backoff(args.backoff_initial, args.backoff_max)
+    interval = connection.PollInterval(args.sleep, args.sleep_min, args.sleep_max)
+    extra = accounts()
+    rest = False
 
-        if other:
-            out = f"%{{F{args.channel_color}}}{args.chat_prefix}"
-        elif private:
-            out = f"%{{F{args.user_color}}}{args.chat_prefix}"
-        else:
-            out = args.chat_prefix
+    def main_status() -> Status:
+        nonlocal mm, rest
+        status = daemon_status(args, shown)
+        rest = status is None
+
+        if status is None:
+            deadline = connection.Deadline(args.deadline)
+
+            if not mm:
+                mm = init_mattermost(args, polybar_error, deadline)
+
+            mm.deadline = deadline
 
-        # Join all channels with pipe
-        msg = " | ".join(other + private)
+            # The session (and its keep-alive connections) is kept on errors,
+            # and only renewed if the server rejects the token
+            status = get_status(args, mm, shown, polybar_error)
 
-        # If we have prefix and output - insert space between prefix and output
-        if msg and args.chat_prefix:
-            msg = " " + msg
+        return status
+
+    # Polls run in a worker thread, so the last known status can be shown
+    # if a poll does not finish within the deadline
+    pool = ThreadPoolExecutor(1, thread_name_prefix="refresh")
+    rendered = render.RenderCache(output)
+    polled = False
+
+    while True:
+        refresh = pool.submit(merged_status, main_status, extra)
 
-        print(out + msg)
         try:
-            sys.stdout.flush()
-        except BrokenPipeError:
-            pass
-        time.sleep(args.sleep)
+            (summary, ok) = refresh.result(args.deadline or None)
+        except TimeoutError:
+            polybar_error(args, "Timeout")
+            (summary, ok) = refresh.result()
 
+        if not ok:
+            wait_refresh(min(args.sleep, backoff.delay()))
+            continue
 
-def waybar_error(args: Config, message: str) -> None:
-    print(json.dumps({"text": message, "class": "error"}))
+        backoff.reset()
 
+        (line, changed) = rendered(summary)
+        print(line)
+        render.flush_stdout()
 
-def waybar() -> None:
-    """Output channel status in waybar format"""
+        # Only the first poll is profiled
+        profiling.finish()
 
-    args: Config = cast(Config, arguments.handle_args(Config, "mmstatus"))
+        # Only polls of the REST API are adapted, polls served by mmwatch
+        # cost the server nothing. The first poll waits the initial interval
+        if polled and (rest or any(account.rest for account in extra)):
+            seconds = interval.next(changed, screen_idle())
+        else:
+            seconds = args.sleep
 
-    mm = init_mattermost(args, error=waybar_error)
+        polled = True
 
-    (private, other, ok) = get_status(args, mm, waybar_error)
+        if wait_refresh(seconds):
+            debug("refresh signal received")
+        else:
+            debug("refresh after %ss", seconds)
 
-    if private:
-        klass = "private"
-    else:
-        klass = "other"
 
-    # Join all channels with pipe
-    msg = f"{args.chat_prefix}" + " | ".join(other + private)
+def waybar() -> None:
+    """Output channel status in waybar format"""
+    run("waybar")
 
-    # If we have prefix and output - insert space between prefix and output
-    if msg and args.chat_prefix:
-        msg = " " + msg
 
-    print(json.dumps({"text": msg, "class": klass}))
-    try:
-        sys.stdout.flush()
-    except BrokenPipeError:
-        pass
+def json_output() -> None:
+    """Output unread state as json, for scripts and other status bars"""
+    run("json")
 
 
 def main() -> None:
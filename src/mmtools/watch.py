@@ -1,9 +1,13 @@
 """mmtools - watch"""
 
+import asyncio
 import json
+import logging
 import os
-import re
 import signal
+import time
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
 from logging import debug, info, warning
 from subprocess import CalledProcessError, check_output
 from typing import Any, cast
@@ -11,20 +15,74 @@ from typing import Any, cast
 import notify2  # type: ignore
 from pydantic import Field
 
-from mmtools import arguments
+from mmtools import (
+    arguments,
+    broker,
+    connection,
+    daemon,
+    journal,
+    metrics,
+    profiling,
+    rules,
+)
+from mmtools.channel import Channel, direct_user
+from mmtools.events import decode_event, parse_event_type
 from mmtools.mattermost import Mattermost
 
+# Max number of notifications/signals waiting to be sent. If exceeded,
+# the websocket loop waits before handling more events
+MAX_PENDING = 100
+
 
 class Config(arguments.Config):
     no_verify: bool = Field(False, description="SSL verify")
 
     no_notify: bool = Field(False, description="Disable notifications")
     pkill: str = Field("i3blocks", description="Send SIGUSR1 to process matching value")
+    notify_window: float = Field(
+        2.0,
+        description="Combine posts in the same channel that follow a notification within this many seconds to one notification (0=disabled)",
+    )
+    signal_interval: float = Field(
+        1.0, description="Minimum seconds between signals to --pkill process"
+    )
+    no_journal: bool = Field(
+        False, description="Do not journal handled events (replayed on startup)"
+    )
+    journal_max_bytes: int = Field(
+        8 * 1024 * 1024, description="Rotate event journal when larger than this"
+    )
+    journal_sync_interval: float = Field(
+        1.0, description="Maximum seconds between writes of the event journal to disk"
+    )
+    broker: bool = Field(
+        False,
+        description="Publish events to local subscribers on a unix socket (see mmevents)",
+    )
+    broker_buffer: int = Field(
+        1000,
+        description="Events buffered per subscriber, the oldest are dropped if exceeded",
+    )
+
+
+def notify_send(summary: str, body: str, urgent: bool = False) -> None:
+    """Send notification message, with critical urgency if urgent"""
+    notification = notify2.Notification(summary, body, "notification-message-im")
 
+    if urgent:
+        notification.set_urgency(notify2.URGENCY_CRITICAL)
 
-def notify_send(summary: str, body: str) -> None:
-    """Send notification message"""
-    notify2.Notification(summary, body, "notification-message-im").show()
+    notification.show()
+
+
+# Events that are only logged at debug level
+DEBUG_EVENTS = (
+    "status_change",
+    "typing",
+    "channel_member_updated",
+    "user_added",
+    None,
+)
 
 
 def get_pid(name: str) -> int:
@@ -42,36 +100,148 @@ class EventHandler:
     def __init__(
         self,
         mm: Mattermost,
-        ignore_channels: str | None,
+        channel_filter: rules.ChannelFilter | None,
         pkill: str,
         no_notify: bool,
         chat_prefix: str,
+        notify_window: float = 0,
+        signal_interval: float = 0,
+        event_journal: journal.Journal | None = None,
+        event_broker: broker.Broker | None = None,
     ):
         self.event_map = {
             "posted": self.event_posted,
             "channel_viewed": self.event_channel_viewed,
+            "multiple_channels_viewed": self.event_multiple_channels_viewed,
         }
 
-        self.ignore_channels = ignore_channels
+        self.channel_filter = channel_filter
         self.mm = mm
         self.pkill = pkill
         self.no_notify = no_notify
         self.chat_prefix = chat_prefix
 
+        # Notifications (D-Bus) and signals are sent from a single worker thread,
+        # so they do not block the websocket loop and are sent in order
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="mmwatch")
+        self.pending = asyncio.Semaphore(MAX_PENDING)
+        self.pid = 0
+
+        # Posts waiting to be notified, per channel
+        self.notify_window = notify_window
+        self.batches: dict[str, list[tuple[str, str]]] = {}
+
+        self.signal_interval = signal_interval
+        self.last_signal = -signal_interval
+        self.signal_scheduled = False
+
+        # Keep references to scheduled tasks, so they are not garbage collected
+        self.tasks: set[asyncio.Task[None]] = set()
+
+        # Handled events are journaled, and replayed (without notifications)
+        # on the next startup
+        self.journal = event_journal
+        self.replaying = False
+
+        # Events are published to local subscribers (--broker)
+        self.broker = event_broker
+
+    def schedule(self, delay: float, coro: Callable[[], Awaitable[None]]) -> None:
+        """Run coroutine function after delay seconds"""
+
+        async def delayed() -> None:
+            await asyncio.sleep(delay)
+            await coro()
+
+        task = asyncio.get_running_loop().create_task(delayed())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run_in_background(self, func: Callable[..., None], *args: Any) -> None:
+        """
+        Run blocking function in worker thread without waiting for it
+        to finish. Waits if there are more than MAX_PENDING functions
+        waiting to run (backpressure)
+        """
+        await self.pending.acquire()
+        asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args
+        ).add_done_callback(self.background_done)
+
+    def background_done(self, future: asyncio.Future[None]) -> None:
+        """Called (in event loop) when background function is done"""
+        self.pending.release()
+
+        if not future.cancelled() and future.exception():
+            warning("Background task failed: %s", future.exception())
+
+    def signal_process(self) -> None:
+        """
+        Send SIGUSR2 to process matching pkill. The pid is cached, and
+        only looked up again when the process is gone
+        """
+        for _ in range(2):
+            if not self.pid:
+                self.pid = get_pid(self.pkill)
+
+            if not self.pid:
+                return
+
+            try:
+                info("kill SIGUSR2 %s (%s)", self.pid, self.pkill)
+                os.kill(self.pid, signal.SIGUSR2)
+                metrics.inc("mmtools_signals_total")
+                return
+            except ProcessLookupError:
+                debug("process %s (%s) is gone", self.pid, self.pkill)
+                self.pid = 0
+
     async def event_channel_viewed(self, event: dict[str, Any]) -> None:
         """Websocket event handler for channel views"""
         data = event.get("data", {})
 
         channel_id = data.get("channel_id")
 
-        info(json.dumps(data, indent=4, sort_keys=True))
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            info(json.dumps(data, indent=4, sort_keys=True))
 
         info(f"channel viewed: {channel_id}")
 
+        if channel_id:
+            self.mm.channels.viewed(channel_id)
+
+    async def event_multiple_channels_viewed(self, event: dict[str, Any]) -> None:
+        """Websocket event handler for multiple channel views"""
+        channel_times = event.get("data", {}).get("channel_times", {})
+
+        info(f"channels viewed: {list(channel_times)}")
+
+        for channel_id in channel_times:
+            self.mm.channels.viewed(channel_id)
+
     async def event_posted(self, event: dict[str, Any]) -> None:
         """Websocket event handler for posts"""
         data = event["data"]
         post = data.get("post", {})
+        channel_name = data.get("channel_name", "")
+
+        if "__" in channel_name:
+            # Lookup username (might need a request) in a worker thread before
+            # updating state, so neither will block the websocket loop
+            channel_name = await asyncio.get_running_loop().run_in_executor(
+                self.mm.executor,
+                self.mm.get_user,
+                direct_user(channel_name, self.mm.user.id),
+            )
+
+        # Replayed posts (missed while disconnected) are already counted, since
+        # channels are updated before they are replayed
+        if not event.get("replayed"):
+            self.mm.channels.posted(self.mm, self.mm.user.id, post, data)
+
+        # Posts replayed from the journal were notified by the previous run
+        if self.replaying:
+            return
 
         # Do not notify on messages sent from myself
         if post.get("user_id") == self.mm.user.id:
@@ -82,64 +252,206 @@ class EventHandler:
             return
 
         name = data.get("sender_name").rstrip("@")
-        channel_name = data.get("channel_name")
-
-        if "__" in channel_name:
-            sender_user_id, _ = channel_name.split("__")
 
-            if sender_user_id == self.mm.user.id:
-                return
-
-            channel_name = self.mm.get_user(sender_user_id)
+        channel = self.mm.channels.state.get(post.get("channel_id", ""))
 
-        if self.ignore_channels and re.search(self.ignore_channels, channel_name):
+        if self.channel_filter and channel and not self.channel_filter(channel):
             return
 
         message = post.get("message", "")
 
-        channel = f"{self.chat_prefix} {channel_name}/{name}"
+        # Mentions (including direct messages) are notified with higher priority
+        mentioned = self.mm.user.id in (data.get("mentions") or [])
 
         if not self.no_notify:
-            notify_send(channel.strip(), message[:1024].strip())
+            await self.notify(channel_name, name, message, mentioned)
 
         if self.pkill:
-            pid = get_pid(self.pkill)
+            await self.signal()
+
+    async def notify(
+        self, channel_name: str, name: str, message: str, urgent: bool = False
+    ) -> None:
+        """
+        Notify on post. The first post in a channel is notified at once, the
+        posts that follow within notify_window seconds are combined to one
+        notification at the end of the window. Urgent posts (mentions) are
+        always notified at once, with critical urgency
+        """
+        if channel_name in self.batches and not urgent:
+            self.batches[channel_name].append((name, message))
+            return
+
+        await self.send_notification(channel_name, [(name, message)], urgent)
+
+        if not self.notify_window or channel_name in self.batches:
+            return
+
+        self.batches[channel_name] = []
+
+        async def flush() -> None:
+            await self.send_notification(
+                channel_name, self.batches.pop(channel_name, [])
+            )
+
+        self.schedule(self.notify_window, flush)
+
+    async def send_notification(
+        self, channel_name: str, posts: list[tuple[str, str]], urgent: bool = False
+    ) -> None:
+        """Send one notification for posts in channel"""
+        if not posts:
+            return
+
+        if len(posts) == 1:
+            (name, message) = posts[0]
+            summary = f"{self.chat_prefix} {channel_name}/{name}"
+            message = message[:1024]
+        else:
+            summary = f"{self.chat_prefix} {channel_name} ({len(posts)} messages)"
+            message = "\n".join(f"{name}: {message}" for (name, message) in posts)
+
+        metrics.inc("mmtools_notifications_total", urgent=str(urgent).lower())
 
-            if pid:
-                info("kill SIGUSR2 %s (%s)", pid, self.pkill)
-                os.kill(pid, signal.SIGUSR2)
+        # Show the latest messages if combined message is too long
+        await self.run_in_background(
+            notify_send, summary.strip(), message[-1024:].strip(), urgent
+        )
+
+    async def signal(self) -> None:
+        """
+        Signal pkill process. At most one signal is sent every signal_interval
+        seconds, signals within the interval are combined to one signal at
+        the end of the interval
+        """
+        if self.signal_scheduled:
+            return
+
+        loop = asyncio.get_running_loop()
+        delay = self.last_signal + self.signal_interval - loop.time()
+
+        async def send() -> None:
+            self.signal_scheduled = False
+            self.last_signal = loop.time()
+            await self.run_in_background(self.signal_process)
+
+        if delay <= 0:
+            await send()
+        else:
+            self.signal_scheduled = True
+            self.schedule(delay, send)
 
     async def event_handler(self, event: str) -> None:
         """Websocket event handler"""
 
-        debug_event = (
-            "status_change",
-            "typing",
-            "channel_member_updated",
-            "user_added",
-            None,
+        # Only decode the event type first, most events (e.g typing) are not
+        # handled and only logged at debug level
+        event_type = parse_event_type(event)
+
+        if metrics.ENABLED and not self.replaying:
+            metrics.inc("mmtools_websocket_events_total", type=event_type or "")
+
+        # Events are only decoded for subscribers if there are any
+        publish = bool(self.broker and self.broker.active and not self.replaying)
+
+        if event_type in self.event_map:
+            if self.journal and not self.replaying:
+                self.journal_event(event)
+
+            start = time.perf_counter()
+            decoded = decode_event(event)
+            await self.event_map[event_type](decoded)
+            metrics.observe(
+                "mmtools_event_handler_seconds",
+                time.perf_counter() - start,
+                type=event_type,
+            )
+
+            if publish:
+                self.publish(decoded)
+            return
+
+        level = logging.DEBUG if event_type in DEBUG_EVENTS else logging.INFO
+        log = logging.getLogger().isEnabledFor(level)
+
+        if log or publish:
+            decoded = decode_event(event)
+
+            if log:
+                logging.log(level, json.dumps(decoded, indent=4, sort_keys=True))
+
+            if publish and event_type:
+                self.publish(decoded)
+
+    def publish(self, event: dict[str, Any]) -> None:
+        """Publish event to local subscribers, unless it is in a hidden channel"""
+        assert self.broker
+
+        channel_id = (event.get("broadcast") or {}).get("channel_id") or (
+            event.get("data") or {}
+        ).get("channel_id")
+        channel = self.mm.channels.state.get(channel_id or "")
+
+        if self.channel_filter and channel and not self.channel_filter(channel):
+            return
+
+        self.broker.publish(event)
+
+    def journal_event(self, event: str) -> None:
+        """
+        Append event to journal. Writes to disk are batched, at most one
+        sync every sync_interval seconds
+        """
+        assert self.journal
+
+        if not self.journal.unsynced:
+
+            async def sync() -> None:
+                if self.journal:
+                    self.journal.sync()
+
+            self.schedule(self.journal.sync_interval, sync)
+
+        self.journal.append(event)
+
+        if self.journal.full:
+            # Replay starts at the channel cache, so older events are not needed
+            self.mm.save_channel_cache()
+            self.journal.rotate()
+
+    async def restore(self) -> None:
+        """
+        Restore state of the previous run: load the channel cache, and replay
+        the events journaled after the cache was saved
+        """
+        saved = await asyncio.get_running_loop().run_in_executor(
+            None, self.mm.load_channel_cache
         )
 
-        d = json.loads(event)
-        if "data" in d:
-            for field, value in d["data"].items():
-                # Attempt to parse as json in data fields
-                if isinstance(field, str):
-                    try:
-                        d["data"][field] = json.loads(value)
-                    except ValueError:
-                        pass
-                    except TypeError:
-                        pass
-
-        event = d.get("event", None)
-
-        if event in self.event_map:
-            await self.event_map[event](d)
-        elif event in debug_event:
-            debug(json.dumps(d, indent=4, sort_keys=True))
-        else:
-            info(json.dumps(d, indent=4, sort_keys=True))
+        if saved is None or not self.journal:
+            return
+
+        start = time.perf_counter()
+        self.replaying = True
+
+        try:
+            with profiling.phase("replay journal"):
+                count = await journal.replay(
+                    journal.read(self.journal.path, saved), self.event_handler
+                )
+        finally:
+            self.replaying = False
+
+        info(
+            "replayed %s events from %s in %.3fs",
+            count,
+            self.journal.path,
+            time.perf_counter() - start,
+        )
+
+    def state(self) -> list[Channel]:
+        """Channels with unread messages"""
+        return self.mm.channels.channels
 
 
 def main() -> None:
@@ -148,13 +460,108 @@ def main() -> None:
 
     notify2.init("mmtools")
 
-    mm = Mattermost(args)
+    # The main account, and additional accounts (--accounts) with the account
+    # name in notifications
+    configs = [("", args, args.chat_prefix)] + [
+        (name, cast(Config, account), f"{args.chat_prefix} {name}".strip())
+        for (name, account) in arguments.ACCOUNTS.items()
+    ]
+
+    def event_handler(
+        mm: Mattermost, account: Config, chat_prefix: str
+    ) -> EventHandler:
+        return EventHandler(
+            mm,
+            rules.ChannelFilter(
+                rules.parse(account.channel_rules, account.ignore), lambda: mm.teams
+            ),
+            args.pkill,
+            args.no_notify,
+            chat_prefix,
+            args.notify_window,
+            args.signal_interval,
+            None
+            if args.no_journal
+            else journal.Journal(
+                journal.journal_file(account.server, account.port, account.user),
+                args.journal_max_bytes,
+                args.journal_sync_interval,
+            ),
+            broker.Broker(args.broker_buffer) if args.broker else None,
+        )
 
-    handler = EventHandler(
-        mm, args.ignore, args.pkill, args.no_notify, args.chat_prefix
-    )
+    # Accounts that are up, stopped when mmwatch exits
+    handlers: list[EventHandler] = []
+    servers = []
+
+    async def retry(name: str, func: Callable[[], Any]) -> Any:
+        """
+        Run blocking func in a worker thread. Errors of the main account are
+        raised, additional accounts are retried with backoff, so an account
+        that is unreachable does not stop the other accounts
+        """
+        loop = asyncio.get_running_loop()
+        backoff = connection.Backoff(args.backoff_initial, args.backoff_max)
+
+        while True:
+            try:
+                return await loop.run_in_executor(None, func)
+            except Exception as e:
+                if not name:
+                    raise
+
+                delay = backoff.delay()
+                warning("account %s: %s, retrying in %.1f seconds", name, e, delay)
+                await asyncio.sleep(delay)
+
+    async def watch(name: str, account: Config, chat_prefix: str) -> None:
+        """Login, serve the state of account and watch its websocket"""
+        mm: Mattermost = await retry(name, lambda: Mattermost(account))
+        handler = event_handler(mm, account, chat_prefix)
+        handlers.append(handler)
+
+        if not args.no_daemon:
+            # Serve the state of the previous run at once, it is replaced when
+            # the channels are updated from the server below
+            await handler.restore()
+
+            path = daemon.socket_path(
+                account.server, account.port, account.user, account.socket
+            )
+            servers.append((await daemon.start_server(path, handler.state), path))
+
+            await retry(name, mm.init_channels)
+
+        if handler.broker:
+            await handler.broker.start(
+                broker.events_path(
+                    account.server, account.port, account.user, account.socket
+                )
+            )
+
+        # Only startup (of the main account) is profiled
+        if not name:
+            profiling.finish()
+
+        await mm.watch_websocket(handler.event_handler)
+
+    # The websockets (and the state servers) of all accounts run on one event
+    # loop. Accounts login (or resume sessions) concurrently
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        loop.run_until_complete(asyncio.gather(*(watch(*config) for config in configs)))
+    finally:
+        for server, path in servers:
+            daemon.stop_server(server, path)
+
+        for handler in handlers:
+            if handler.journal:
+                handler.journal.close()
 
-    mm.init_websocket(handler.event_handler)
+            if handler.broker:
+                handler.broker.stop()
 
 
 if __name__ == "__main__":